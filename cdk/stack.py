@@ -43,6 +43,13 @@ class SimplePostsStack(Stack):
             sort_key = _dynamodb.Attribute(name = "time", type = _dynamodb.AttributeType.STRING)
         )
 
+        # Sparse index with all posts newest first per time bucket - GET / queries it instead of scanning the table
+        dynamodb_post_table_timeline_index = dynamodb_post_table.add_global_secondary_index(
+            index_name = "timeline_index",
+            partition_key = _dynamodb.Attribute(name = "timeBucket", type = _dynamodb.AttributeType.STRING),
+            sort_key = _dynamodb.Attribute(name = "time", type = _dynamodb.AttributeType.STRING)
+        )
+
         apigw_api = _apigw.CfnApi(
             self, "ApiGwThreadApi",
             description = "Handles all requests between clients and the application",
@@ -65,14 +72,16 @@ class SimplePostsStack(Stack):
                             resources = [
                                 dynamodb_post_table.table_arn,
                                 f"{dynamodb_post_table.table_arn}/index/author_postid_index",
-                                f"{dynamodb_post_table.table_arn}/index/postid_time_index"
+                                f"{dynamodb_post_table.table_arn}/index/postid_time_index",
+                                f"{dynamodb_post_table.table_arn}/index/timeline_index"
                             ]
                         ),
                         _iam.PolicyStatement(
                             effect = _iam.Effect.ALLOW,
                             actions = [
                                 "verifiedpermissions:isauthorized",
-                                "verifiedpermissions:isauthorizedwithtoken"
+                                "verifiedpermissions:isauthorizedwithtoken",
+                                "verifiedpermissions:batchisauthorizedwithtoken"
                             ],
                             resources = ["*"]
                         )
@@ -89,13 +98,28 @@ class SimplePostsStack(Stack):
             role = lambda_func_main_exec_role,
             log_retention = _logs.RetentionDays.FIVE_DAYS,
             environment = {
-                "TableName": dynamodb_post_table.table_name
+                "TableName": dynamodb_post_table.table_name,
+                "TimelineBucketSeconds": "86400",
+                "PolicyDirectory": "/opt",
+                "PolicyEvaluation": "remote",
+                "LogLevel": "INFO",
+                "ConcurrentReads": "true",
+                # Requests per second and burst per user and route, batch routes cost up to 4 AVP calls each
+                "RateLimitRate": "10",
+                "RateLimitBurst": "20",
+                "RateLimits": json.dumps({"BatchDeletePosts": {"rate": 1, "burst": 5}})
             },
             layers = [
                 _lambda.LayerVersion(
                     self, "LambdaLayer",
                     code = _lambda.Code.from_asset("./layers/main/"),
                     compatible_runtimes = [_lambda.Runtime.PYTHON_3_10]
+                ),
+                # Ships the policies and schema to /opt for the local policy engine
+                _lambda.LayerVersion(
+                    self, "PolicyLayer",
+                    code = _lambda.Code.from_asset("./cdk/policy_store/"),
+                    compatible_runtimes = [_lambda.Runtime.PYTHON_3_10]
                 )
             ]
         )
@@ -162,6 +186,9 @@ class SimplePostsStack(Stack):
             supported_identity_providers = [_cognito.UserPoolClientIdentityProvider.COGNITO]
         )
 
+        lambda_func_main.add_environment(key = "UserPoolIssuer", value = f"https://cognito-idp.{_aws.REGION}.amazonaws.com/{cognito_up.user_pool_id}")
+        lambda_func_main.add_environment(key = "UserPoolClientId", value = cognito_up_client.user_pool_client_id)
+
         cognito_up_domain = cognito_up.add_domain(
             "CognitoDomain",
             cognito_domain = _cognito.CognitoDomainOptions(
@@ -209,6 +236,15 @@ class SimplePostsStack(Stack):
             authorizer_id = apigw_authorizer.attr_authorizer_id
         )
 
+        apigw_route_posts_batch_post = _apigw.CfnRoute(
+            self, "ApiGwThreadRouteThreadBatchPost",
+            api_id = apigw_api.attr_api_id,
+            route_key = "POST /posts/batch",
+            target = "integrations/" + apigw_integration_main.ref,
+            authorization_type = "JWT",
+            authorizer_id = apigw_authorizer.attr_authorizer_id
+        )
+
         apigw_route_posts_delete = _apigw.CfnRoute(
             self, "ApiGwThreadRouteThreadDelete",
             api_id = apigw_api.attr_api_id,
@@ -218,6 +254,15 @@ class SimplePostsStack(Stack):
             authorizer_id = apigw_authorizer.attr_authorizer_id
         )
 
+        apigw_route_posts_batch_delete = _apigw.CfnRoute(
+            self, "ApiGwThreadRouteThreadBatchDelete",
+            api_id = apigw_api.attr_api_id,
+            route_key = "DELETE /posts",
+            target = "integrations/" + apigw_integration_main.ref,
+            authorization_type = "JWT",
+            authorizer_id = apigw_authorizer.attr_authorizer_id
+        )
+
         lambda_func_main.add_permission(
             "ApiGwMainRoutePermission",
             principal = _iam.ServicePrincipal("apigateway.amazonaws.com"),
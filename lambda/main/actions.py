@@ -2,5 +2,16 @@ ACTIONS = {
     ("/", "GET"): "GetAllPosts",
     ("/posts", "GET"): "GetUserPosts",
     ("/posts", "POST"): "CreatePost",
-    ("/posts/{postId}", "DELETE"): "DeletePost"
+    ("/posts/{postId}", "DELETE"): "DeletePost",
+    ("/posts/batch", "POST"): "BatchCreatePosts",
+    ("/posts", "DELETE"): "BatchDeletePosts"
 }
+
+# Routes without an action of their own in the policy store are authorized as the action they perform per item
+POLICY_ACTIONS = {
+    "BatchCreatePosts": "CreatePost",
+    "BatchDeletePosts": "DeletePost"
+}
+
+# Routes that are not authorized once per request, but per post with the batch API
+PER_POST_ACTIONS = ("BatchDeletePosts",)
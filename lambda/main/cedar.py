@@ -0,0 +1,515 @@
+import glob
+import json
+import os
+import re
+
+from collections import namedtuple
+
+
+"""
+Minimal Cedar evaluator for the policies in cdk/policy_store
+
+Supports the subset of Cedar the bundled policies use: permit/forbid with principal,
+action and resource scopes (==, in), when/unless conditions with &&, ||, !, ==, !=,
+<, <=, >, >=, in, has, attribute access, if-then-else, sets, entity, string, long and
+boolean literals. Policies are parsed and indexed by action once per container.
+"""
+
+
+Entity = namedtuple("Entity", ["type", "id"])
+Policy = namedtuple("Policy", ["policy_id", "effect", "principal", "action", "resource", "conditions"])
+Decision = namedtuple("Decision", ["decision", "determining_policies", "errors"])
+
+
+class CedarError(Exception):
+    pass
+
+
+class EvaluationError(CedarError):
+    pass
+
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+|//[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?\d+)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>::|==|!=|<=|>=|&&|\|\||[()\[\]{},;.!<>])
+""", re.VERBOSE)
+
+SCOPE_VARIABLES = ("principal", "action", "resource")
+VARIABLES = SCOPE_VARIABLES + ("context",)
+COMPARISONS = {"==": "eq", "!=": "ne", "<": "lt", "<=": "le", ">": "gt", ">=": "ge", "in": "in"}
+
+
+"""
+Parsing
+"""
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match:
+            raise CedarError(f"Unexpected character {text[position]!r} at offset {position}")
+
+        position = match.end()
+        kind = match.lastgroup
+
+        if kind == "space":
+            continue
+
+        value = match.group()
+        if kind == "string":
+            value = json.loads(value)
+        elif kind == "number":
+            value = int(value)
+
+        tokens.append((kind, value))
+
+    return tokens
+
+
+class Parser:
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+
+    def peek(self, offset = 0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise CedarError("Unexpected end of policy")
+
+        self.position += 1
+        return token
+
+
+    def accept(self, value):
+        if self.peek()[1] == value and self.peek()[0] in ("op", "ident"):
+            self.position += 1
+            return True
+
+        return False
+
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise CedarError(f"Expected {value!r}, got {self.peek()[1]!r}")
+
+
+    def parse_policies(self, source):
+        policies = []
+
+        while self.peek()[0] is not None:
+            policies.append(self.parse_policy(f"{source}#{len(policies)}"))
+
+        return policies
+
+
+    def parse_policy(self, policy_id):
+        kind, effect = self.next()
+        if effect not in ("permit", "forbid"):
+            raise CedarError(f"Expected permit or forbid, got {effect!r}")
+
+        self.expect("(")
+        principal = self.parse_scope("principal")
+        self.expect(",")
+        action = self.parse_scope("action")
+        self.expect(",")
+        resource = self.parse_scope("resource")
+        self.expect(")")
+
+        conditions = []
+        while self.peek()[1] in ("when", "unless"):
+            kind, keyword = self.next()
+            self.expect("{")
+            expression = self.parse_expression()
+            self.expect("}")
+            conditions.append(expression if keyword == "when" else ("not", expression))
+
+        self.expect(";")
+
+        return Policy(policy_id, effect, principal, action, resource, conditions)
+
+
+    def parse_scope(self, variable):
+        self.expect(variable)
+
+        if self.accept("=="):
+            return ("eq", [self.parse_entity()])
+
+        if self.accept("in"):
+            if variable == "action" and self.accept("["):
+                entities = [self.parse_entity()]
+                while self.accept(","):
+                    entities.append(self.parse_entity())
+                self.expect("]")
+                return ("in", entities)
+
+            return ("in", [self.parse_entity()])
+
+        return None
+
+
+    def parse_entity(self):
+        kind, name = self.next()
+        if kind != "ident":
+            raise CedarError(f"Expected entity type, got {name!r}")
+
+        path = [name]
+        while self.accept("::"):
+            kind, value = self.next()
+            if kind == "string":
+                return Entity("::".join(path), value)
+
+            path.append(value)
+
+        raise CedarError(f"Expected entity id after {'::'.join(path)}")
+
+
+    def parse_expression(self):
+        if self.accept("if"):
+            condition = self.parse_expression()
+            self.expect("then")
+            then_branch = self.parse_expression()
+            self.expect("else")
+            else_branch = self.parse_expression()
+            return ("if", condition, then_branch, else_branch)
+
+        return self.parse_or()
+
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.accept("||"):
+            left = ("or", left, self.parse_and())
+
+        return left
+
+
+    def parse_and(self):
+        left = self.parse_relation()
+        while self.accept("&&"):
+            left = ("and", left, self.parse_relation())
+
+        return left
+
+
+    def parse_relation(self):
+        left = self.parse_unary()
+
+        if self.accept("has"):
+            kind, name = self.next()
+            if kind not in ("ident", "string"):
+                raise CedarError(f"Expected attribute name after has, got {name!r}")
+            return ("has", left, name)
+
+        operator = self.peek()[1]
+        if operator in COMPARISONS and self.peek()[0] in ("op", "ident"):
+            self.next()
+            return (COMPARISONS[operator], left, self.parse_unary())
+
+        return left
+
+
+    def parse_unary(self):
+        if self.accept("!"):
+            return ("not", self.parse_unary())
+
+        return self.parse_member()
+
+
+    def parse_member(self):
+        expression = self.parse_primary()
+
+        while self.accept("."):
+            kind, name = self.next()
+            if kind != "ident":
+                raise CedarError(f"Expected attribute name, got {name!r}")
+            expression = ("attr", expression, name)
+
+        return expression
+
+
+    def parse_primary(self):
+        kind, value = self.peek()
+
+        if kind in ("string", "number"):
+            self.next()
+            return ("lit", value)
+
+        if self.accept("("):
+            expression = self.parse_expression()
+            self.expect(")")
+            return expression
+
+        if self.accept("["):
+            items = []
+            if not self.accept("]"):
+                items.append(self.parse_expression())
+                while self.accept(","):
+                    items.append(self.parse_expression())
+                self.expect("]")
+            return ("set", items)
+
+        if kind == "ident":
+            if value in ("true", "false"):
+                self.next()
+                return ("lit", value == "true")
+
+            if value in VARIABLES:
+                self.next()
+                return ("var", value)
+
+            return ("lit", self.parse_entity())
+
+        raise CedarError(f"Unexpected token {value!r}")
+
+
+"""
+Evaluation
+"""
+
+
+class PolicySet:
+
+    def __init__(self, policies, schema = None):
+        self.policies = policies
+        self.schema = schema
+        self.namespace = next(iter(schema)) if schema else None
+        self.action_parents = {}
+
+        if schema:
+            action_type = f"{self.namespace}::Action"
+            for action_id, definition in schema[self.namespace].get("actions", {}).items():
+                self.action_parents[Entity(action_type, action_id)] = [
+                    Entity(parent.get("type", action_type), parent["id"])
+                    for parent in definition.get("memberOf", [])
+                ]
+
+        # Pre-index the policies by action, so a request only looks at policies that can apply
+        self.index = {action: self._policies_for(action) for action in self.action_parents}
+
+
+    @classmethod
+    def from_directory(cls, directory, schema_file = "schema.json"):
+        policies = []
+
+        for path in sorted(glob.glob(os.path.join(directory, "*.cedar"))):
+            with open(path, "r") as f:
+                policies.extend(Parser(f.read()).parse_policies(os.path.basename(path)))
+
+        schema = None
+        schema_path = os.path.join(directory, schema_file)
+        if os.path.exists(schema_path):
+            with open(schema_path, "r") as f:
+                schema = json.load(f)
+
+        if not policies:
+            raise CedarError(f"No policies found in {directory}")
+
+        return cls(policies, schema)
+
+
+    def action_entity(self, action_id):
+        return Entity(f"{self.namespace}::Action", action_id)
+
+
+    def referenced_attributes(self, action, variable = "resource") -> set:
+
+        """
+        Names of the attributes of principal, resource or context that the policies for
+        an action read or test with has - nested access like resource.owner.name counts as owner
+        """
+
+        attributes = set()
+
+        def walk(node):
+            if not isinstance(node, tuple):
+                if isinstance(node, list):
+                    for item in node:
+                        walk(item)
+                return
+
+            if node[0] in ("attr", "has") and node[1] == ("var", variable):
+                attributes.add(node[2])
+
+            for item in node[1:]:
+                walk(item)
+
+        for policy in self.index.get(action, self.policies):
+            for condition in policy.conditions:
+                walk(condition)
+
+        return attributes
+
+
+    def _policies_for(self, action):
+        ancestors = self._ancestors(action, {})
+        applicable = []
+
+        for policy in self.policies:
+            if policy.action is None or any(entity in ancestors for entity in policy.action[1]):
+                applicable.append(policy)
+
+        return applicable
+
+
+    def _ancestors(self, entity, entities):
+        """ The entity itself and every entity it is transitively a member of """
+        result = {entity}
+        pending = [entity]
+
+        while pending:
+            current = pending.pop()
+            parents = self.action_parents.get(current) or entities.get(current, {}).get("parents", [])
+            for parent in parents:
+                if parent not in result:
+                    result.add(parent)
+                    pending.append(parent)
+
+        return result
+
+
+    def is_authorized(self, principal, action, resource, entities = None, context = None):
+        request = {
+            "principal": principal,
+            "action": action,
+            "resource": resource,
+            "context": context or {},
+            "entities": entities or {}
+        }
+
+        policies = self.index.get(action)
+        if policies is None:
+            policies = self._policies_for(action)
+
+        satisfied = {"permit": [], "forbid": []}
+        errors = []
+
+        for policy in policies:
+            try:
+                if self._matches(policy, request):
+                    satisfied[policy.effect].append(policy.policy_id)
+            except EvaluationError as e:
+                # Cedar skips policies that fail to evaluate
+                errors.append(f"{policy.policy_id}: {e}")
+
+        if satisfied["forbid"]:
+            return Decision("DENY", satisfied["forbid"], errors)
+
+        if satisfied["permit"]:
+            return Decision("ALLOW", satisfied["permit"], errors)
+
+        return Decision("DENY", [], errors)
+
+
+    def _matches(self, policy, request):
+        for variable in SCOPE_VARIABLES:
+            scope = getattr(policy, variable)
+            if scope is None:
+                continue
+
+            operator, entities = scope
+            value = request[variable]
+
+            if operator == "eq" and value != entities[0]:
+                return False
+
+            if operator == "in" and not self._ancestors(value, request["entities"]).intersection(entities):
+                return False
+
+        for condition in policy.conditions:
+            if self._boolean(self._evaluate(condition, request)) is not True:
+                return False
+
+        return True
+
+
+    def _boolean(self, value):
+        if not isinstance(value, bool):
+            raise EvaluationError(f"Expected a boolean, got {value!r}")
+
+        return value
+
+
+    def _attributes(self, value, request):
+        if isinstance(value, Entity):
+            if value not in request["entities"]:
+                raise EvaluationError(f"Entity {value.type}::\"{value.id}\" does not exist")
+            return request["entities"][value].get("attrs", {})
+
+        if isinstance(value, dict):
+            return value
+
+        raise EvaluationError(f"Expected an entity or record, got {value!r}")
+
+
+    def _evaluate(self, node, request):
+        kind = node[0]
+
+        if kind == "lit":
+            return node[1]
+
+        if kind == "var":
+            return request[node[1]]
+
+        if kind == "set":
+            return [self._evaluate(item, request) for item in node[1]]
+
+        if kind == "attr":
+            attributes = self._attributes(self._evaluate(node[1], request), request)
+            if node[2] not in attributes:
+                raise EvaluationError(f"Attribute {node[2]!r} does not exist")
+            return attributes[node[2]]
+
+        if kind == "has":
+            target = self._evaluate(node[1], request)
+            if isinstance(target, Entity) and target not in request["entities"]:
+                return False
+            return node[2] in self._attributes(target, request)
+
+        if kind == "not":
+            return not self._boolean(self._evaluate(node[1], request))
+
+        if kind == "and":
+            return self._boolean(self._evaluate(node[1], request)) and self._boolean(self._evaluate(node[2], request))
+
+        if kind == "or":
+            return self._boolean(self._evaluate(node[1], request)) or self._boolean(self._evaluate(node[2], request))
+
+        if kind == "if":
+            branch = node[2] if self._boolean(self._evaluate(node[1], request)) else node[3]
+            return self._evaluate(branch, request)
+
+        left = self._evaluate(node[1], request)
+        right = self._evaluate(node[2], request)
+
+        if kind == "eq":
+            return left == right
+
+        if kind == "ne":
+            return left != right
+
+        if kind == "in":
+            if not isinstance(left, Entity):
+                raise EvaluationError(f"Expected an entity on the left of in, got {left!r}")
+            candidates = right if isinstance(right, list) else [right]
+            return bool(self._ancestors(left, request["entities"]).intersection(candidates))
+
+        if kind in ("lt", "le", "gt", "ge"):
+            if not (isinstance(left, int) and isinstance(right, int)) or isinstance(left, bool) or isinstance(right, bool):
+                raise EvaluationError(f"Expected two longs, got {left!r} and {right!r}")
+            return {"lt": left < right, "le": left <= right, "gt": left > right, "ge": left >= right}[kind]
+
+        raise EvaluationError(f"Unknown expression {kind!r}")
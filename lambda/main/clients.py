@@ -0,0 +1,106 @@
+import os
+import threading
+
+
+"""
+Lazily constructed AWS clients shared by all modules
+
+Nothing here imports boto3 until the first client is requested, so routes that fail
+early never pay for it. All clients and resources come from one boto3 session and
+therefore share one botocore session, its loaders and credential provider chain.
+Clients are thread-safe, MaxPoolConnections sets how many connections each of them
+keeps open for concurrent requests (botocore default 10).
+
+Verified Permissions sits on the path of every request, so its client retries in
+adaptive mode - after a throttle it also rate limits its own calls instead of adding
+to the load - and gives up on slow connections and responses early (AvpRetryMode,
+AvpMaxAttempts, AvpConnectTimeout, AvpReadTimeout).
+"""
+
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_tables = {}
+
+max_pool_connections = int(os.environ.get("MaxPoolConnections", "10"))
+
+# Config per service on top of the connection pool
+service_config = {
+    "verifiedpermissions": {
+        "retries": {
+            "mode": os.environ.get("AvpRetryMode", "adaptive"),
+            "max_attempts": int(os.environ.get("AvpMaxAttempts", "3"))
+        },
+        "connect_timeout": float(os.environ.get("AvpConnectTimeout", "1")),
+        "read_timeout": float(os.environ.get("AvpReadTimeout", "1"))
+    }
+}
+
+
+def session():
+    global _session
+
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3
+                _session = boto3.session.Session()
+
+    return _session
+
+
+def config(service_name = None):
+    from botocore.config import Config
+
+    return Config(max_pool_connections = max_pool_connections, **service_config.get(service_name, {}))
+
+
+def client(service_name):
+    if service_name not in _clients:
+        with _lock:
+            if service_name not in _clients:
+                _clients[service_name] = session().client(service_name, config = config(service_name))
+
+    return _clients[service_name]
+
+
+def table(table_name):
+    if table_name not in _tables:
+        with _lock:
+            if table_name not in _tables:
+                _tables[table_name] = session().resource("dynamodb", config = config()).Table(table_name)
+
+    return _tables[table_name]
+
+
+def verified_permissions():
+    return client("verifiedpermissions")
+
+
+def override(service_name = None, service_client = None, table_name = None, table = None):
+
+    """
+    Swap in a stand-in for a client or a table, e.g. for the local benchmark
+    """
+
+    with _lock:
+        if service_name:
+            _clients[service_name] = service_client
+
+        if table_name:
+            _tables[table_name] = table
+
+
+def warm(table_name = None):
+
+    """
+    Construct everything up front - used with ClientInit=eager, so provisioned
+    concurrency or the init phase pays for it instead of the first request
+    """
+
+    verified_permissions()
+
+    if table_name:
+        table(table_name)
+        client("dynamodb")
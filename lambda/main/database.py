@@ -1,63 +1,877 @@
-import boto3
+import base64
+import binascii
+import contextvars
+import heapq
+import itertools
+import json
 import os
+import random
+import threading
 import time
 import uuid
+import zlib
 
-from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import clients
+import log
+import metrics
+import models
+import readcache
 
 table_name = os.environ.get("TableName")
 
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(table_name)
 
+# List routes return pages, so response size and latency stay flat as the table grows
+default_page_size = int(os.environ.get("DefaultPageSize", "50"))
+max_page_size = int(os.environ.get("MaxPageSize", "100"))
+
+# GET / walks the timeline_index back one time bucket per round of queries until the page is full,
+# at most TimelineMaxQueries rounds once it has posts and TimelineMaxWalk rounds while it has none
+timeline_bucket_seconds = int(os.environ.get("TimelineBucketSeconds", "86400"))
+timeline_max_queries = int(os.environ.get("TimelineMaxQueries", "10"))
+timeline_max_walk = int(os.environ.get("TimelineMaxWalk", "100"))
+
+# The posts of a bucket are spread over this many partitions of the timeline_index, all read at once -
+# changing it needs tools/backfill_timeline.py and ends all GET / cursors handed out before
+timeline_shards = int(os.environ.get("TimelineShards", "1"))
+
+# How long the oldest bucket with posts is taken from the marker item without reading it again
+timeline_oldest_ttl = int(os.environ.get("TimelineOldestTtl", "60"))
+
+# BatchWriteItem takes at most 25 items, unprocessed items are retried with exponential backoff and jitter
+batch_write_size = 25
+batch_write_attempts = int(os.environ.get("BatchWriteAttempts", "6"))
+batch_write_backoff = float(os.environ.get("BatchWriteBackoff", "0.05"))
+
+# Parallel GSI queries when resolving the owners of many posts at once
+owner_lookup_workers = int(os.environ.get("OwnerLookupWorkers", "8"))
+
+# Columns the list routes read - a page of one author's posts does not need the author on every item
+FEED_COLUMNS = ("postId", "userId", "author", "text", "time")
+AUTHOR_FEED_COLUMNS = ("postId", "userId", "text", "time")
+
+# Every lookup needs the keys of the item - postId identifies the post, userId is needed to delete it
+KEY_COLUMNS = ("postId", "userId")
+
+# postId -> userId - a post never changes its owner, so entries only go away on delete or eviction
+owner_cache = cache.LRUCache(int(os.environ.get("OwnerCacheSize", "4096")))
+
+# Marks the oldest time bucket with posts - no index has its keys, so it is never read as a post
+TIMELINE_MARKER = {"userId": "#timeline", "postId": "#oldest"}
+
+# value: last read from the marker, written: oldest bucket this container made sure is marked
+_oldest_bucket = {"value": None, "expires": 0.0, "written": None}
+_oldest_bucket_lock = threading.Lock()
+_timeline_executor = None
+_timeline_lock = threading.Lock()
+
+# Post ids created in the same millisecond by this process are numbered, so they still sort in creation order
+_last_post_id = [0, 0]
+_post_id_lock = threading.Lock()
+
+
+def get_client():
+    # Plain low-level client - items stay in the wire format, see models.Post
+    return clients.client("dynamodb")
+
+
+def get_table():
+    return clients.table(table_name)
+
+
+def key(name):
+    # Imported on first use, boto3 is not loaded before the first database call
+    from boto3.dynamodb.conditions import Key
+
+    return Key(name)
+
+
+def key_equals(name, value):
+    return key(name).eq(value)
+
+
+def bucket_start(timestamp) -> int:
+    return int(timestamp) // timeline_bucket_seconds * timeline_bucket_seconds
+
+
+def timeline_partition(bucket, shard) -> str:
+    return str(bucket) if timeline_shards == 1 else f"{bucket}#{shard}"
+
+
+def time_bucket(timestamp, postid) -> str:
+
+    """
+    The timeBucket of a post - the start of its time bucket, with TimelineShards > 1
+    followed by the shard its postId hashes to, e.g. "1700006400#3"
+    """
+
+    return timeline_partition(bucket_start(timestamp), zlib.crc32(postid.encode()) % timeline_shards)
+
+
+def note_bucket(bucket: int):
+
+    """
+    Make sure the marker is not newer than a bucket that is about to get a post - called
+    before the post is written, so no post is ever older than the marker. New posts are
+    never older than the ones before, so this costs one conditional write per container.
+    """
+
+    if _oldest_bucket["written"] is not None and bucket >= _oldest_bucket["written"]:
+        return
+
+    table = get_table()
+
+    try:
+        with metrics.span("DynamoDBUpdateItem"):
+            response = table.update_item(
+                Key = TIMELINE_MARKER,
+                UpdateExpression = "SET oldestBucket = :bucket",
+                ConditionExpression = "attribute_not_exists(oldestBucket) OR oldestBucket > :bucket",
+                ExpressionAttributeValues = {":bucket": bucket},
+                ReturnConsumedCapacity = "TOTAL"
+            )
+        metrics.consumed_capacity(response)
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        # The marker is as old or older already
+        pass
+
+    with _oldest_bucket_lock:
+        if _oldest_bucket["written"] is None or bucket < _oldest_bucket["written"]:
+            _oldest_bucket["written"] = bucket
+
+
+def oldest_bucket():
+
+    """
+    The oldest time bucket with posts, None if no post was ever written - the marker is
+    read again after timeline_oldest_ttl seconds, posts this container wrote count at once
+    """
+
+    now = time.time()
+
+    if _oldest_bucket["value"] is None or now >= _oldest_bucket["expires"]:
+        with metrics.span("DynamoDBGetItem"):
+            response = get_client().get_item(
+                TableName = table_name,
+                Key = to_wire(TIMELINE_MARKER),
+                ProjectionExpression = "oldestBucket",
+                ReturnConsumedCapacity = "TOTAL"
+            )
+        metrics.consumed_capacity(response)
+
+        item = response.get("Item")
+        if item and "oldestBucket" in item:
+            _oldest_bucket["value"] = int(item["oldestBucket"]["N"])
+            _oldest_bucket["expires"] = now + timeline_oldest_ttl
+
+    known = [bucket for bucket in (_oldest_bucket["value"], _oldest_bucket["written"]) if bucket is not None]
+
+    return min(known) if known else None
+
+
+def remember_owners(posts):
+    for post in posts:
+        if post.get("postId") and post.get("userId"):
+            owner_cache.put(post["postId"], post["userId"])
+
+    return posts
+
+
+def get_post_owner(postid):
+
+    """
+    Resolve the owner of a post from the cache, fall back to a GSI query that
+    only projects the keys instead of pulling the whole item
+    """
+
+    owner = owner_cache.get(postid)
+    if owner:
+        return owner
+
+    return query_post_owner(get_table().meta.client, postid)
+
+
+def query_post_owner(query_client, postid):
+    with metrics.span("DynamoDBOwnerQuery"):
+        response = query_client.query(
+            TableName = table_name,
+            IndexName = "postid_time_index",
+            KeyConditionExpression = key_equals("postId", postid),
+            ProjectionExpression = "userId, postId",
+            ReturnConsumedCapacity = "TOTAL"
+        )
+
+    metrics.consumed_capacity(response)
+    items = response["Items"]
+
+    if not items:
+        return None
+
+    owner = items[0]["userId"]
+    owner_cache.put(postid, owner)
+
+    return owner
+
+
+def query_post(query_client, postid, columns):
+
+    """
+    Only the given columns of a post, e.g. the ones an authorization plan needs
+    """
+
+    # Columns like time and text are reserved words in expressions
+    names = {f"#c{index}": name for index, name in enumerate(columns)}
+
+    with metrics.span("DynamoDBResourceQuery"):
+        response = query_client.query(
+            TableName = table_name,
+            IndexName = "postid_time_index",
+            KeyConditionExpression = key_equals("postId", postid),
+            ProjectionExpression = ", ".join(names),
+            ExpressionAttributeNames = names,
+            ReturnConsumedCapacity = "TOTAL"
+        )
+
+    metrics.consumed_capacity(response)
+    items = response["Items"]
+
+    if not items:
+        return None
+
+    owner_cache.put(postid, items[0]["userId"])
+
+    return items[0]
+
+
+def get_post(postid, columns = KEY_COLUMNS):
+
+    """
+    The columns of a post needed to authorize and run an action, None if it does not exist -
+    lookups that only need the keys are answered from the owner cache when possible
+    """
+
+    if set(columns) <= set(KEY_COLUMNS):
+        owner = get_post_owner(postid)
+        return {"postId": postid, "userId": owner} if owner else None
+
+    return query_post(get_table().meta.client, postid, columns)
+
+
+def get_posts(postids, columns = KEY_COLUMNS):
+
+    """
+    get_post for many posts, in parallel - returns {postId: post} without the posts that do not exist
+    """
+
+    if set(columns) <= set(KEY_COLUMNS):
+        return {postid: {"postId": postid, "userId": owner} for postid, owner in get_post_owners(postids).items()}
+
+    query_client = get_table().meta.client
+    contexts = [contextvars.copy_context() for _ in postids]
+    posts = {}
+
+    def lookup(context, postid):
+        return context.run(query_post, query_client, postid, columns)
+
+    with ThreadPoolExecutor(max_workers = max(1, min(len(postids), owner_lookup_workers))) as executor:
+        for postid, post in zip(postids, executor.map(lookup, contexts, postids)):
+            if post:
+                posts[postid] = post
+
+    return posts
+
+
+def get_post_owners(postids):
+
+    """
+    Resolve the owners of many posts - cached owners first, the rest with projected
+    GSI queries in parallel. Returns {postId: userId} without the posts that do not exist.
+    """
+
+    owners = {}
+    missing = []
+
+    for postid in postids:
+        owner = owner_cache.get(postid)
+
+        if owner:
+            owners[postid] = owner
+        else:
+            missing.append(postid)
+
+    if missing:
+        query_client = get_table().meta.client
+
+        # One context copy per query, so the metrics of the lookups count towards this request
+        contexts = [contextvars.copy_context() for _ in missing]
+
+        def lookup(context, postid):
+            return context.run(query_post_owner, query_client, postid)
+
+        with ThreadPoolExecutor(max_workers = min(len(missing), owner_lookup_workers)) as executor:
+            for postid, owner in zip(missing, executor.map(lookup, contexts, missing)):
+                if owner:
+                    owners[postid] = owner
+
+    return owners
+
+
+def projection(columns, names) -> str:
+    for index, name in enumerate(columns):
+        names[f"#c{index}"] = name
+
+    return ", ".join(f"#c{index}" for index in range(len(columns)))
+
+
+def to_wire(key) -> dict:
+    # All key attributes of the table and its indexes are strings
+    return {name: {"S": value} for name, value in key.items()} if key else None
+
+
+def from_wire(key) -> dict:
+    return {name: value["S"] for name, value in key.items()} if key else None
+
+
+def page_limit(limit) -> int:
+    if limit is None:
+        return default_page_size
+
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be a positive number")
+
+    if limit < 1:
+        raise ValueError("limit must be a positive number")
+
+    return min(limit, max_page_size)
+
+
+def encode_cursor(last_key) -> str:
+    if not last_key:
+        return None
+
+    return base64.urlsafe_b64encode(json.dumps(last_key, separators = (",", ":")).encode()).decode()
+
+
+def is_key(value) -> bool:
+    return isinstance(value, dict) and all(isinstance(item, str) for item in value.values())
+
+
+def decode_json_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("malformed cursor")
+
+
+def decode_cursor(cursor, author = None) -> dict:
+
+    """
+    Cursors are the LastEvaluatedKey of the previous page - raises ValueError if the
+    cursor was not produced by encode_cursor or belongs to another author's page
+    """
+
+    if not cursor:
+        return None
+
+    start_key = decode_json_cursor(cursor)
+
+    if not is_key(start_key):
+        raise ValueError("malformed cursor")
+
+    if author is not None and start_key.get("author") != author:
+        raise ValueError("cursor belongs to another author")
+
+    return start_key
+
+
+def decode_timeline_cursor(cursor) -> dict:
+
+    """
+    Timeline cursors hold the time bucket to continue in and per shard the key to continue
+    after (None to start at the newest post) - shards listed in done have no more posts in it
+    """
 
-def get_post_details(postid):
-    post = table.query(
-        IndexName = "postid_time_index",
-        KeyConditionExpression = Key("postId").eq(postid)
+    if not cursor:
+        return None
+
+    position = decode_json_cursor(cursor)
+
+    # Made before TimelineShards was changed - its keys belong to partitions that are not read any more
+    if isinstance(position, dict) and isinstance(position.get("keys"), list) and len(position["keys"]) != timeline_shards:
+        raise ValueError("cursor is outdated, request the first page again")
+
+    if not (
+        isinstance(position, dict)
+        and isinstance(position.get("bucket"), str) and position["bucket"].isdigit()
+        and isinstance(position.get("keys"), list)
+        and all(key is None or is_key(key) for key in position["keys"])
+        and isinstance(position.get("done"), list)
+        and all(isinstance(shard, int) and 0 <= shard < timeline_shards for shard in position["done"])
+    ):
+        raise ValueError("malformed cursor")
+
+    return position
+
+
+def timeline_bound(before) -> int:
+    if before is None:
+        return None
+
+    try:
+        before = int(before)
+    except (TypeError, ValueError):
+        raise ValueError("before must be an epoch timestamp in seconds")
+
+    if before < 0:
+        raise ValueError("before must be an epoch timestamp in seconds")
+
+    return before
+
+
+def get_all_posts(limit = None, cursor = None, before = None):
+
+    """
+    Newest posts first, optionally only posts created before an epoch timestamp.
+    Reads the timeline_index one time bucket after another - all shards of a bucket at
+    once - down to the oldest bucket with posts, so every post can be reached. A request
+    walks on until it has posts, after that it returns after timeline_max_queries rounds.
+    Only after timeline_max_walk rounds without any post is a page empty and still has a
+    cursor. A short page with a cursor means the walk stopped early, not that posts are missing.
+    """
+
+    limit = page_limit(limit)
+    before = timeline_bound(before)
+    position = decode_timeline_cursor(cursor)
+    oldest = oldest_bucket()
+
+    if position:
+        bucket, keys, done = int(position["bucket"]), position["keys"], set(position["done"])
+    else:
+        bucket, keys, done = bucket_start(time.time() if before is None else before), [None] * timeline_shards, set()
+
+    posts = []
+    rounds = 0
+
+    while oldest is not None and bucket >= oldest and len(posts) < limit:
+        if rounds >= (timeline_max_queries if posts else timeline_max_walk):
+            break
+
+        rounds += 1
+        remaining = limit - len(posts)
+        shards = [shard for shard in range(timeline_shards) if shard not in done]
+        pages = query_timeline(bucket, shards, keys, remaining, before)
+
+        # Each shard's page is newest first - the newest of all of them are the next posts
+        newest = heapq.merge(
+            *[[(post, shard) for post in pages[shard][0]] for shard in shards],
+            key = lambda entry: entry[0].time,
+            reverse = True
+        )
+        taken = list(itertools.islice(newest, remaining))
+        posts.extend(post for post, _ in taken)
+
+        for shard in shards:
+            items, last_key = pages[shard]
+            count = sum(1 for _, taken_shard in taken if taken_shard == shard)
+
+            if count == len(items) and last_key is None:
+                done.add(shard)
+            elif count:
+                item = items[count - 1]
+                keys[shard] = {"userId": item._userId, "postId": item.postId, "time": item.time, "timeBucket": timeline_partition(bucket, shard)}
+
+        if len(done) == timeline_shards:
+            bucket, keys, done = bucket - timeline_bucket_seconds, [None] * timeline_shards, set()
+
+    if oldest is None or bucket < oldest:
+        return remember_owners(posts), None
+
+    return remember_owners(posts), encode_cursor({"bucket": str(bucket), "keys": keys, "done": sorted(done)})
+
+
+def query_timeline(bucket, shards, keys, limit, before) -> dict:
+
+    """
+    Query the shards of a time bucket, in parallel if there is more than one -
+    returns {shard: (posts, LastEvaluatedKey)}
+    """
+
+    global _timeline_executor
+
+    names = {"#bucket": "timeBucket"}
+    condition = "#bucket = :bucket"
+
+    if before is not None:
+        names["#time"] = "time"
+        condition += " AND #time < :before"
+
+    columns = projection(FEED_COLUMNS, names)
+
+    def query(shard):
+        values = {":bucket": {"S": timeline_partition(bucket, shard)}}
+        if before is not None:
+            values[":before"] = {"S": str(before)}
+
+        args = {
+            "TableName": table_name,
+            "IndexName": "timeline_index",
+            "KeyConditionExpression": condition,
+            "ProjectionExpression": columns,
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+            "ScanIndexForward": False,
+            "Limit": limit,
+            "ReturnConsumedCapacity": "TOTAL"
+        }
+        if keys[shard]:
+            args["ExclusiveStartKey"] = to_wire(keys[shard])
+
+        with metrics.span("DynamoDBQuery"):
+            page = get_client().query(**args)
+        metrics.consumed_capacity(page)
+
+        return [models.Post.from_item(item) for item in page["Items"]], page.get("LastEvaluatedKey")
+
+    if len(shards) == 1:
+        return {shards[0]: query(shards[0])}
+
+    if _timeline_executor is None:
+        with _timeline_lock:
+            if _timeline_executor is None:
+                _timeline_executor = ThreadPoolExecutor(max_workers = timeline_shards)
+
+    # Every query gets its own copy of the context, so its spans count for this request
+    futures = {shard: _timeline_executor.submit(contextvars.copy_context().run, query, shard) for shard in shards}
+
+    return {shard: future.result() for shard, future in futures.items()}
+
+
+def get_user_posts(author, limit = None, cursor = None, version = None, before = None, after = None):
+
+    """
+    One page of an author's posts, newest first - optionally only posts created before
+    and after epoch timestamps, which postIds turn into a range of the sort key. From the
+    read cache if the page was read at the author's current version before. Pass the
+    version if it was read earlier, e.g. for an ETag.
+    """
+
+    limit = page_limit(limit)
+    start_key = decode_cursor(cursor, author)
+    post_ids = author_range(before, after, start_key)
+    bounds = [before, after] if before is not None or after is not None else None
+
+    if post_ids is None:
+        return [], None
+
+    lowest, highest = post_ids
+
+    if version is None:
+        version = readcache.version(author)
+
+    cached = readcache.get(author, version, limit, cursor, bounds)
+    if cached:
+        posts = [models.Post(postid, author, text, timestamp, userid) for postid, text, timestamp, userid in cached["posts"]]
+        return remember_owners(posts), cached["cursor"]
+
+    names = {"#author": "author"}
+    values = {":author": {"S": author}}
+    condition = "#author = :author"
+
+    if lowest is not None or highest is not None:
+        names["#postId"] = "postId"
+
+    if lowest is not None and highest is not None:
+        condition += " AND #postId BETWEEN :lowest AND :highest"
+    elif lowest is not None:
+        condition += " AND #postId >= :lowest"
+    elif highest is not None:
+        condition += " AND #postId <= :highest"
+
+    if lowest is not None:
+        values[":lowest"] = {"S": lowest}
+    if highest is not None:
+        values[":highest"] = {"S": highest}
+
+    args = {
+        "TableName": table_name,
+        "IndexName": "author_postid_index",
+        "KeyConditionExpression": condition,
+        "ProjectionExpression": projection(AUTHOR_FEED_COLUMNS, names),
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+        "ScanIndexForward": False,
+        "Limit": limit,
+        "ReturnConsumedCapacity": "TOTAL"
+    }
+
+    if start_key:
+        args["ExclusiveStartKey"] = to_wire(start_key)
+
+    with metrics.span("DynamoDBQuery"):
+        page = get_client().query(**args)
+    metrics.consumed_capacity(page)
+
+    posts = [models.Post.from_item(item, author) for item in page["Items"]]
+    next_cursor = encode_cursor(from_wire(page.get("LastEvaluatedKey")))
+
+    readcache.put(author, version, limit, cursor, {
+        "posts": [[post.postId, post.text, post.time, post._userId] for post in posts],
+        "cursor": next_cursor
+    }, bounds)
+
+    return remember_owners(posts), next_cursor
+
+
+def new_post_id(timestamp_ms = None) -> str:
+
+    """
+    UUIDv7 - 48 bits of Unix time in milliseconds, a 12 bit sequence and 62 random bits.
+    The time comes first, so postIds sort by creation time as strings, also as the sort
+    key of the author_postid_index. Pass the time of an existing post to give it an id of
+    its own time, e.g. in tools/migrate_post_ids.py.
+    """
+
+    if timestamp_ms is None:
+        with _post_id_lock:
+            timestamp_ms = max(time.time_ns() // 1_000_000, _last_post_id[0])
+            sequence = _last_post_id[1] + 1 if timestamp_ms == _last_post_id[0] else random.getrandbits(11)
+
+            # Sequence exhausted - borrow the next millisecond instead of going back in order
+            if sequence > 0xfff:
+                timestamp_ms, sequence = timestamp_ms + 1, 0
+
+            _last_post_id[:] = [timestamp_ms, sequence]
+    else:
+        sequence = random.getrandbits(12)
+
+    value = (
+        (timestamp_ms & 0xffffffffffff) << 80
+        | 0x7 << 76
+        | sequence << 64
+        | 0b10 << 62
+        | int.from_bytes(os.urandom(8), "big") >> 2
     )
 
-    if post:
-        return post["Items"]
+    return str(uuid.UUID(int = value))
+
+
+def post_id_bound(timestamp_ms, upper = False) -> str:
+
+    """
+    The lowest - or with upper, the highest - postId of a millisecond, for range conditions on postId
+    """
+
+    return str(uuid.UUID(int = timestamp_ms << 80 | ((1 << 80) - 1 if upper else 0)))
+
+
+def post_id_time(postid) -> int:
+
+    """
+    The Unix time in milliseconds a UUIDv7 postId starts with
+    """
+
+    return uuid.UUID(postid).int >> 80
+
+
+def author_range(before = None, after = None, start_key = None):
+
+    """
+    The postIds of the posts created after and before two epoch timestamps in seconds,
+    both exclusive - returns (lowest, highest) with None for an open end, or None if no
+    post can be in between. Raises ValueError for invalid bounds or a cursor outside of them.
+    """
 
-    return None
+    before = timeline_bound(before)
+    after = timeline_bound(after)
 
+    if before is not None and (before == 0 or (after is not None and after + 1 >= before)):
+        return None
 
-def get_all_posts():
-    items = table.scan()["Items"]
+    lowest = post_id_bound((after + 1) * 1000) if after is not None else None
+    highest = post_id_bound(before * 1000 - 1, upper = True) if before is not None else None
 
-    return [item for item in items]
+    if start_key and not (
+        (lowest is None or start_key["postId"] >= lowest)
+        and (highest is None or start_key["postId"] <= highest)
+    ):
+        raise ValueError("cursor is outside of before and after")
 
+    return lowest, highest
 
-def get_user_posts(author):
-    items = table.query(
-        IndexName = "author_postid_index",
-        KeyConditionExpression = Key("author").eq(author)
-    )["Items"]
 
-    return items
+def new_post(userid, text, author):
+    postid = new_post_id()
+
+    # The time the id was made for - a burst of posts can borrow the next millisecond, even the next second
+    timestamp = str(post_id_time(postid) // 1000)
+
+    return {
+        "userId": userid,
+        "time": timestamp,
+        "timeBucket": time_bucket(timestamp, postid),
+        "text": text,
+        "postId": postid,
+        "author": author
+    }
 
 
 def create_post(userid, text, author):
-    timestamp = str(int(time.time()))
-    post_id = str(uuid.uuid4())
-
-    attributes = table.put_item(
-        Item = {
-            "userId": userid,
-            "time": timestamp,
-            "text": text,
-            "postId": post_id,
-            "author": author
-        }
-    )#["Attributes"]
+    item = new_post(userid, text, author)
+    note_bucket(bucket_start(item["time"]))
+
+    with metrics.span("DynamoDBPutItem"):
+        response = get_table().put_item(
+            Item = item,
+            ReturnConsumedCapacity = "TOTAL"
+        )
+    metrics.consumed_capacity(response)
+
+    owner_cache.put(item["postId"], userid)
+    readcache.bump(author)
+
+    return models.Post.from_record(item)
+
+
+def batch_write(write_requests) -> list:
+
+    """
+    Send put and delete requests with BatchWriteItem, 25 per call - unprocessed requests are
+    retried with exponential backoff and jitter, returns the ones still unprocessed after all retries.
+    A call that fails counts the rest of its chunk as unprocessed, the other chunks are still sent.
+    """
+
+    from botocore.exceptions import ClientError
+
+    batch_client = get_table().meta.client
+    unprocessed = []
+
+    for start in range(0, len(write_requests), batch_write_size):
+        request_items = {table_name: write_requests[start:start + batch_write_size]}
+
+        for attempt in range(batch_write_attempts):
+            try:
+                with metrics.span("DynamoDBBatchWriteItem"):
+                    response = batch_client.batch_write_item(RequestItems = request_items, ReturnConsumedCapacity = "TOTAL")
+            except ClientError as e:
+                log.error("Batch write failed", error = e.response.get("Error", {}).get("Code"), requests = len(request_items[table_name]))
+                break
+
+            metrics.consumed_capacity(response)
+            request_items = response.get("UnprocessedItems") or {}
+
+            if not request_items or attempt == batch_write_attempts - 1:
+                break
 
-    return attributes
+            time.sleep(random.uniform(0, batch_write_backoff * 2 ** attempt))
+
+        unprocessed.extend(request_items.get(table_name, []))
+
+    return unprocessed
+
+
+def create_posts(userid, texts, author):
+
+    """
+    Write many posts in batches - returns (post, written) pairs in the order of texts,
+    written is False if the post was still unprocessed after all retries
+    """
+
+    items = [new_post(userid, text, author) for text in texts]
+    if items:
+        note_bucket(min(bucket_start(item["time"]) for item in items))
+
+    unprocessed = {
+        request["PutRequest"]["Item"]["postId"]
+        for request in batch_write([{"PutRequest": {"Item": item}} for item in items])
+    }
+
+    results = []
+    for item in items:
+        written = item["postId"] not in unprocessed
+        if written:
+            owner_cache.put(item["postId"], userid)
+        results.append((models.Post.from_record(item), written))
+
+    if len(unprocessed) < len(items):
+        readcache.bump(author)
+
+    return results
+
+
+def delete_posts(owners) -> dict:
+
+    """
+    Delete many posts, owners maps postId to userId - returns {postId: "deleted" | "not_found" | "failed"}.
+    BatchWriteItem cannot say whether an item was there, so every post gets its own conditional
+    delete, in parallel - a post deleted meanwhile or known by a stale owner is reported not_found.
+    """
+
+    from botocore.exceptions import ClientError
+
+    contexts = [contextvars.copy_context() for _ in owners]
+
+    def remove(context, postid):
+        try:
+            return context.run(delete_item, owners[postid], postid)
+        except ClientError as e:
+            log.error("Delete failed", postId = postid, error = e.response.get("Error", {}).get("Code"))
+            return False
+
+    results = {}
+    authors = set()
+
+    with ThreadPoolExecutor(max_workers = max(1, min(len(owners), owner_lookup_workers))) as executor:
+        for postid, removed in zip(owners, executor.map(remove, contexts, owners)):
+            if removed is False:
+                results[postid] = "failed"
+            elif removed is None:
+                results[postid] = "not_found"
+            else:
+                results[postid] = "deleted"
+                authors.add(removed.get("author"))
+
+    for author in authors:
+        readcache.bump(author)
+
+    return results
 
 
 def delete_post(post_owner, postid):
-    table.delete_item(
-        Key = {"userId" : post_owner, "postId": postid}
-    )
+    removed = delete_item(post_owner, postid)
+
+    if removed is None:
+        return None
+
+    # The deleted item tells whose pages to invalidate
+    readcache.bump(removed.get("author"))
 
     return "Done"
+
+
+def delete_item(post_owner, postid):
+
+    """
+    Delete a post if it exists - returns the deleted item, None if there was none
+    """
+
+    owner_cache.invalidate(postid)
+
+    # The owner may come from a cache in another container that has not seen the delete yet
+    try:
+        with metrics.span("DynamoDBDeleteItem"):
+            response = get_table().delete_item(
+                Key = {"userId" : post_owner, "postId": postid},
+                ConditionExpression = "attribute_exists(postId)",
+                ReturnValues = "ALL_OLD",
+                ReturnConsumedCapacity = "TOTAL"
+            )
+    except get_table().meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+    metrics.consumed_capacity(response)
+
+    return response.get("Attributes", {})
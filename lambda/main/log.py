@@ -0,0 +1,155 @@
+import contextvars
+import json
+import os
+import random
+import time
+import traceback
+
+
+"""
+Structured request logging
+
+Every request collects its log events into one record that is printed as a single
+JSON line when the request finishes. Messages below LogLevel, and messages of
+requests that are not sampled, are dropped before anything is formatted. Sample
+rates are set per route in LogSampleRates, e.g. {"GET /": 0.01}; routes without a
+rate use LogSampleRate (default 1). Requests with warnings or errors are always
+printed. Token values are redacted. The request's EMF metrics record is part of the
+same line, and printed on its own for requests that are not logged.
+"""
+
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+level = LEVELS.get(os.environ.get("LogLevel", "INFO").upper(), LEVELS["INFO"])
+default_sample_rate = float(os.environ.get("LogSampleRate", "1"))
+sample_rates = json.loads(os.environ.get("LogSampleRates", "{}"))
+
+REDACTED = "[REDACTED]"
+SENSITIVE_KEYS = {"authorization", "idtoken", "identitytoken", "accesstoken", "refreshtoken", "token", "password"}
+
+_record = contextvars.ContextVar("log_record", default = None)
+
+
+def start(route, **fields):
+    rate = sample_rates.get(route, default_sample_rate)
+
+    _record.set({
+        "route": route,
+        "sampled": random.random() < rate,
+        "started": time.perf_counter(),
+        "fields": dict(fields),
+        "events": [],
+        "problems": False
+    })
+
+
+def enabled(level_name) -> bool:
+    if LEVELS[level_name] < level:
+        return False
+
+    record = _record.get()
+
+    return record is None or record["sampled"] or LEVELS[level_name] >= LEVELS["WARNING"]
+
+
+def annotate(**fields):
+    record = _record.get()
+
+    if record is not None:
+        record["fields"].update(fields)
+
+
+def debug(message, *args, **fields):
+    _log("DEBUG", message, args, fields)
+
+
+def info(message, *args, **fields):
+    _log("INFO", message, args, fields)
+
+
+def warning(message, *args, **fields):
+    _log("WARNING", message, args, fields)
+
+
+def error(message, *args, exc_info = False, **fields):
+    if exc_info:
+        fields["traceback"] = traceback.format_exc()
+
+    _log("ERROR", message, args, fields)
+
+
+def finish(metrics_record = None, **fields):
+
+    """
+    Print the request's line - metrics_record is its EMF record from metrics.finish, CloudWatch
+    reads the metrics from the top level of the line
+    """
+
+    record = _record.get()
+    if record is None:
+        if metrics_record:
+            _emit(metrics_record)
+        return
+
+    _record.set(None)
+
+    if not (record["sampled"] or record["problems"]):
+        if metrics_record:
+            _emit(metrics_record)
+        return
+
+    line = dict(metrics_record or {})
+    line.update({
+        "route": record["route"],
+        "durationMs": round((time.perf_counter() - record["started"]) * 1000, 3)
+    })
+    line.update(record["fields"])
+    line.update(fields)
+
+    if record["events"]:
+        line["events"] = record["events"]
+
+    _emit(line)
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if str(key).lower() in SENSITIVE_KEYS else redact(item)
+            for key, item in value.items()
+        }
+
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+
+    # Catch JWTs that ended up in a message or an unexpected field
+    if isinstance(value, str) and value.startswith("eyJ") and value.count(".") == 2:
+        return REDACTED
+
+    return value
+
+
+def _log(level_name, message, args, fields):
+    if not enabled(level_name):
+        return
+
+    # Only now is anything formatted - callables in fields are evaluated lazily as well
+    event = {"level": level_name, "message": message % args if args else message}
+    for key, value in fields.items():
+        event[key] = value() if callable(value) else value
+
+    record = _record.get()
+
+    if record is None:
+        _emit(event)
+        return
+
+    if LEVELS[level_name] >= LEVELS["WARNING"]:
+        record["problems"] = True
+
+    record["events"].append(event)
+
+
+def _emit(line):
+    print(json.dumps(redact(line), default = str))
@@ -1,23 +1,78 @@
+import base64
+import contextvars
 import json
-import jwt
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import actions
+import clients
 import database
+import log
+import metrics
 import permissions
+import plans
+import ratelimit
+import readcache
+import responses
+import tokens
+
+
+# Provisioned concurrency and the init phase can pay for client construction instead of the first request
+if os.environ.get("ClientInit", "lazy") == "eager":
+    clients.warm(database.table_name)
+
+# Read routes can fetch their data while the permission check is still running
+concurrent_reads = os.environ.get("ConcurrentReads", "false").lower() == "true"
+background_workers = int(os.environ.get("BackgroundWorkers", "4"))
+background = None
+background_lock = threading.Lock()
+
+max_batch_posts = int(os.environ.get("MaxBatchPosts", "100"))
+
+READ_ACTIONS = ("GetAllPosts", "GetUserPosts")
 
 
 def handler(event, context):
 
+    """
+    Entry point - every request is logged as one JSON line with its metrics once it is answered
+    """
+
+    log.start(event.get("routeKey"), requestId = getattr(context, "aws_request_id", None))
+    metrics.start(event.get("routeKey"), requestId = getattr(context, "aws_request_id", None))
+
+    try:
+        response = metrics.profile(route_request, event)
+
+        with metrics.span("Compression"):
+            response = responses.compress(response, (event.get("headers") or {}).get("accept-encoding"))
+    except Exception:
+        log.error("Unhandled exception", exc_info = True)
+        log.finish(metrics.finish(statusCode = 500), statusCode = 500)
+        raise
+
+    log.finish(
+        metrics.finish(statusCode = response["statusCode"]),
+        statusCode = response["statusCode"],
+        encoding = response["headers"].get("Content-Encoding")
+    )
+
+    return response
+
+
+def route_request(event):
+
     """
     Retrieve event details
     """
 
 
-    print(f"EVENT DETAILS\n{event}")
+    log.debug("Event details", event = event)
 
     parameters = event.get("queryStringParameters")
     headers = event["headers"]
-    print(f"HEADERS\n{headers}")
 
     request_details = event.get("routeKey").split(" ")
     path_params = event.get("pathParameters")
@@ -31,37 +86,63 @@ def handler(event, context):
 
     resource = request_details[1]
     method = request_details[0]
-    print(f"RESOURCE\n{resource}\nMETHOD\n{method}")
+    log.debug("Request", resource = resource, method = method)
 
 
     # Map API call to available actions
 
     action = actions.ACTIONS.get((resource, method), "Unknown")
+    log.annotate(action = action)
+
     if action == "Unknown":
         return format_response({"message": "Unknown API call"}, 404)
 
+    # What the policies for this action need to know about the resource
+    policy_action = actions.POLICY_ACTIONS.get(action, action)
+    plan = plans.plan_for(policy_action)
 
-    # Get user details from tokens
 
-    access_token = headers.get("authorization").split(" ")[1]
-    print(f"ACCESS TOKEN\n{access_token}")
+    # Get user details from tokens - verified once per token string, repeat requests come from the cache
 
+    access_token = (headers.get("authorization") or "").split(" ")[-1]
     identity_token = headers.get("idtoken")
-    print(f"IDENTITY TOKEN\n{identity_token}")
 
-    jwt_claims = jwt.decode(access_token, options = {"verify_signature": False})
-    print(f"JWT CLAIMS\n{jwt_claims}")
+    try:
+        with metrics.span("Token"):
+            principal = tokens.access_principal(access_token)
+    except tokens.TokenError as e:
+        log.warning("Rejected access token", error = str(e))
+        return format_response({"message": "Access denied - invalid access token"}, 401)
+    except tokens.KeysUnavailable as e:
+        return keys_unavailable(e)
+
+    log.debug("Access token claims", claims = principal.claims)
+
+    userid = principal.userid
+    author = principal.author
 
-    userid = f"{jwt_claims.get('iss').split('/')[3]}|{jwt_claims.get('sub')}"
-    author = f"{jwt_claims.get('username')}|{jwt_claims.get('sub')[:8]}"
+
+    # Admission control - excess requests are turned away before they cost AVP or DynamoDB capacity
+
+    admitted, retry_after = ratelimit.admit(userid, action)
+
+    if not admitted:
+        metrics.add("Throttled", 1)
+        return format_response({"message": "Too many requests"}, 429, headers = {"Retry-After": str(retry_after)})
 
 
     # Setting some defaults in case they are not set in the request
 
     postid = None
     text = None
+    batch = None
+    postids = None
     post_owner = None
     post_details = None
+    limit = None
+    cursor = None
+    before = None
+    after = None
 
 
     # Override defaults in case they are set in the request
@@ -71,55 +152,165 @@ def handler(event, context):
 
     if parameters:
         author = parameters.get("author") if "author" in parameters else author
+        limit = parameters.get("limit")
+        cursor = parameters.get("cursor")
+        before = parameters.get("before")
+        after = parameters.get("after")
+
+        try:
+            database.page_limit(limit)
+
+            if action == "GetAllPosts":
+                database.timeline_bound(before)
+                database.decode_timeline_cursor(cursor)
+            elif action == "GetUserPosts":
+                database.author_range(before, after, database.decode_cursor(cursor, author))
+            else:
+                database.decode_cursor(cursor)
+        except ValueError as e:
+            return format_response({"message": f"Invalid input, {e}"}, 400)
 
     if postid:
-        post_details = database.get_post_details(postid)[0]
-        print(post_details)
+        # Only the columns the plan asks for - the keys, if the policies only look at the owner
+        with metrics.span("ResourceLookup"):
+            post_details = database.get_post(postid, plan.columns)
+        log.debug("Post details", postId = postid, post = post_details)
 
         if not post_details:
             return format_response({"message": "Invalid input, item does not exist"}, 400)
 
-        post_owner = post_details.get("userId")
+        post_owner = post_details["userId"]
 
 
     """
     Authorize the request - return 401 if check fails
     """
 
-    if permissions.check_permission(identity_token, action, post_details) == "DENY":
+    # Read before the posts, so a page is never older than the version its ETag is made of
+    version = readcache.version(author) if action == "GetUserPosts" else None
+
+    # The read is independent of the decision - start it now and only hand out its result after an ALLOW
+    pending_read = None
+    if concurrent_reads and action in READ_ACTIONS:
+        pending_read = run_in_background(read_posts, action, author, limit, cursor, before, after, version)
+
+    if action in actions.PER_POST_ACTIONS:
+        # Authorized post by post further down
+        decision = None
+    else:
+        try:
+            with metrics.span("Authorization"):
+                decision = permissions.check_permission(identity_token, policy_action, post_details)
+        except tokens.KeysUnavailable as e:
+            # The local policy engine verifies the identity token itself
+            if pending_read:
+                pending_read.cancel()
+
+            return keys_unavailable(e)
+        log.annotate(decision = decision)
+        metrics.annotate(decision = decision)
+
+    if decision == "DENY":
+        if pending_read:
+            pending_read.cancel()
+
         return format_response({"message": "Access denied - permission check failed"}, 401)
 
+    # The client has this page already and nothing was written to the author's posts since -
+    # not decided for a version the author_postid_index may not have caught up with yet
+    etag = None
+    if version is not None and readcache.settled(version):
+        bounds = [before, after] if before is not None or after is not None else None
+        etag = readcache.etag(author, version, database.page_limit(limit), cursor, viewer(identity_token), bounds)
+
+        if etag_matches(headers.get("if-none-match"), etag):
+            if pending_read:
+                pending_read.cancel()
+
+            metrics.add("NotModified", 1)
+            return responses.not_modified({"ETag": etag, "Cache-Control": "private, no-cache"})
+
 
     """
     Capture optional request details
     """
 
     if event.get("body"):
-        body = json.loads(event.get("body"))
-        print(f"JSON BODY\n{body}")
-        text = body.get("text") if "text" in body else None
+        try:
+            # API Gateway and the container server base64 encode bodies that are not UTF-8 text
+            raw = base64.b64decode(event["body"]) if event.get("isBase64Encoded") else event["body"]
+            body = json.loads(raw)
+        except ValueError:
+            # Also not base64, or not UTF-8 once decoded
+            body = None
+
+        if not isinstance(body, dict):
+            if pending_read:
+                pending_read.cancel()
 
-    print(f"TEXT\n{text}")
+            return format_response({"message": "Invalid request body"}, 400)
+
+        log.debug("Request body", body = body)
+        text = body.get("text") if "text" in body else None
+        batch = body.get("posts") if "posts" in body else None
+        postids = body.get("postIds") if "postIds" in body else None
 
 
     """
     Send request to the database
     """
 
-    if action == "GetAllPosts":
-        return get_all_posts()
+    if action in READ_ACTIONS:
+        if pending_read:
+            posts, next_cursor = pending_read.result()
+        else:
+            posts, next_cursor = read_posts(action, author, limit, cursor, before, after, version)
 
-    if action == "GetUserPosts":
-        return get_user_posts(author)
+        with metrics.span("Annotation"):
+            permissions.annotate_posts(identity_token, "DeletePost", posts, "canDelete")
+
+        page = {"posts": posts, "cursor": next_cursor}
+
+        # A short page with a cursor - the walk through the timeline stopped early, the next page has more
+        if next_cursor and len(posts) < database.page_limit(limit):
+            page["partial"] = True
+
+        if etag:
+            return format_response(page, headers = {"ETag": etag, "Cache-Control": "private, no-cache"})
+
+        return format_response(page)
 
     if action == "CreatePost":
         if not text:
             return format_response({"message": "Invalid input, text required."}, 400)
 
-        return create_post(userid, text, author)
+        return format_response(create_post(userid, text, author))
+
+    if action == "BatchCreatePosts":
+        if not isinstance(batch, list) or not batch:
+            return format_response({"message": "Invalid input, posts required."}, 400)
+
+        if len(batch) > max_batch_posts:
+            return format_response({"message": f"Invalid input, at most {max_batch_posts} posts per request."}, 400)
+
+        return format_response({"results": create_posts(userid, batch, author)})
+
+    if action == "BatchDeletePosts":
+        if not isinstance(postids, list) or not postids or not all(isinstance(postid, str) and postid for postid in postids):
+            return format_response({"message": "Invalid input, postIds required."}, 400)
+
+        if len(postids) > max_batch_posts:
+            return format_response({"message": f"Invalid input, at most {max_batch_posts} posts per request."}, 400)
+
+        return format_response({"results": delete_posts(identity_token, plan, list(dict.fromkeys(postids)))})
 
     if action == "DeletePost":
-        return format_response({"message": delete_post(post_owner, postid)})
+        result = delete_post(post_owner, postid)
+
+        if not result:
+            return format_response({"message": "Invalid input, item does not exist"}, 400)
+
+        return format_response({"message": result})
 
     return format_response({"message": "nothing to do but everything alright - or is it?"})
 
@@ -129,30 +320,150 @@ Helper functions for the database to keep main function clean
 """
 
 
-def get_all_posts():
-    return database.get_all_posts()
+def read_posts(action, author, limit, cursor, before, after = None, version = None):
+    if action == "GetAllPosts":
+        return get_all_posts(limit, cursor, before)
+
+    return get_user_posts(author, limit, cursor, version, before, after)
+
+
+def get_all_posts(limit, cursor, before):
+    return database.get_all_posts(limit, cursor, before)
 
 
-def get_user_posts(author):
-    return database.get_user_posts(author)
+def get_user_posts(author, limit, cursor, version, before = None, after = None):
+    return database.get_user_posts(author, limit, cursor, version, before, after)
 
 
 def create_post(userid, text, author):
-    return database.create_post(userid, text, author)
+    post = database.create_post(userid, text, author)
+
+    # The caller owns the new post, and post owners may delete their posts (post_owners.cedar)
+    post.canDelete = True
+
+    return post
+
+
+def create_posts(userid, batch, author):
+
+    """
+    Validate every entry on its own, write the valid ones in batches and report per entry
+    """
+
+    results = [None] * len(batch)
+    texts = []
+    positions = []
+
+    for index, entry in enumerate(batch):
+        text = entry.get("text") if isinstance(entry, dict) else None
+
+        if not text or not isinstance(text, str):
+            results[index] = {"index": index, "status": "invalid", "message": "text required"}
+            continue
+
+        texts.append(text)
+        positions.append(index)
+
+    for index, (post, written) in zip(positions, database.create_posts(userid, texts, author)):
+        if written:
+            post.canDelete = True
+            results[index] = {"index": index, "status": "created", "post": post}
+        else:
+            results[index] = {"index": index, "status": "failed", "message": "not written, try again"}
+
+    return results
+
+
+def delete_posts(identity_token, plan, postids):
+
+    """
+    Fetch what the plan needs of all posts, authorize them with the batch API and delete the allowed ones
+    """
+
+    details = database.get_posts(postids, plan.columns)
+    owners = {postid: post["userId"] for postid, post in details.items()}
+    found = [details[postid] for postid in postids if postid in details]
+    decisions = {}
+
+    for post, decision in zip(found, permissions.check_permissions_batch(identity_token, plan.action, found)):
+        decisions[post["postId"]] = decision
+
+    allowed = {postid: owners[postid] for postid, decision in decisions.items() if decision == "ALLOW"}
+    deleted = database.delete_posts(allowed) if allowed else {}
+
+    results = []
+    for postid in postids:
+        if postid not in owners:
+            results.append({"postId": postid, "status": "not_found"})
+        elif decisions.get(postid) != "ALLOW":
+            results.append({"postId": postid, "status": "denied"})
+        else:
+            results.append({"postId": postid, "status": deleted[postid]})
+
+    log.annotate(**{status: sum(1 for result in results if result["status"] == status) for status in ("deleted", "denied", "not_found", "failed")})
+
+    return results
 
 
 def delete_post(post_owner, postid):
     return database.delete_post(post_owner, postid)
 
 
-def format_response(body, status_code = 200):
-    result = {
-        "statusCode": status_code,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*"
-        },
-        "body": json.dumps(body)
-    }
+def run_in_background(function, *args):
+    global background
+
+    if background is None:
+        with background_lock:
+            if background is None:
+                background = ThreadPoolExecutor(max_workers = background_workers)
+
+    # Copy the context so log events of the background work end up in this request's log line
+    return background.submit(contextvars.copy_context().run, function, *args)
+
+
+def shutdown():
+
+    """
+    Let background work of requests in flight finish - used by the container server on exit
+    """
+
+    if background is not None:
+        background.shutdown(wait = True)
+
+
+def viewer(identity_token):
+
+    """
+    Who a page is rendered for - part of the ETag, as canDelete differs between users and roles
+    """
+
+    try:
+        claims = tokens.identity_claims(identity_token, verify = False)
+    except tokens.TokenError:
+        return None
+
+    return [claims.get("sub"), claims.get("custom:appRole")]
+
+
+def keys_unavailable(error):
+
+    """
+    The tokens could not be checked at all - a server problem, not the caller's
+    """
+
+    log.error("Token verification unavailable", error = str(error))
+    metrics.add("TokenVerificationUnavailable", 1)
+
+    return format_response({"message": "Service unavailable, please retry"}, 503, headers = {"Retry-After": "1"})
+
+
+def etag_matches(if_none_match, etag) -> bool:
+    if not if_none_match:
+        return False
+
+    return any(candidate.strip() in (etag, "*") for candidate in if_none_match.split(","))
+
 
-    return result
+def format_response(body, status_code = 200, headers = None):
+    with metrics.span("Serialization"):
+        return responses.format_response(body, status_code, headers)
@@ -0,0 +1,167 @@
+import contextvars
+import io
+import json
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+"""
+Per-request timing spans in CloudWatch Embedded Metric Format
+
+Every request collects the time spent in named spans (token parsing, owner lookup,
+authorization, DynamoDB calls, serialization, compression), the DynamoDB capacity it
+consumed and properties like the authorization decision. They make one EMF record
+when the request finishes, which log.finish prints as part of the request's log line -
+CloudWatch turns it into metrics per route. Spans with the same name add up, including
+spans in background threads of the request.
+
+Set ProfileSampleRate (default 0) to run a share of the requests under cProfile and
+print the ProfileTop (default 25) functions by cumulative time.
+"""
+
+
+enabled = os.environ.get("Metrics", "true").lower() == "true"
+namespace = os.environ.get("MetricsNamespace", "AvpSimpleThread")
+profile_sample_rate = float(os.environ.get("ProfileSampleRate", "0"))
+profile_top = int(os.environ.get("ProfileTop", "25"))
+
+_request = contextvars.ContextVar("metrics_request", default = None)
+
+
+def start(route, **properties):
+    if not enabled:
+        return
+
+    _request.set({
+        "route": route,
+        "started": time.perf_counter(),
+        "spans": {},
+        "values": {},
+        "properties": dict(properties),
+        "lock": threading.Lock()
+    })
+
+
+@contextmanager
+def span(name):
+    request = _request.get()
+    if request is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+
+        with request["lock"]:
+            request["spans"][name] = request["spans"].get(name, 0.0) + elapsed
+
+
+def add(name, value):
+    request = _request.get()
+    if request is None:
+        return
+
+    with request["lock"]:
+        request["values"][name] = request["values"].get(name, 0) + value
+
+
+def consumed_capacity(response):
+
+    """
+    Add the capacity units of a DynamoDB response requested with ReturnConsumedCapacity
+    """
+
+    capacity = response.get("ConsumedCapacity")
+    if not capacity:
+        return
+
+    if isinstance(capacity, dict):
+        capacity = [capacity]
+
+    add("DynamoDBCapacityUnits", float(sum(entry.get("CapacityUnits", 0) for entry in capacity)))
+
+
+def annotate(**properties):
+    request = _request.get()
+
+    if request is not None:
+        request["properties"].update(properties)
+
+
+def finish(**properties) -> dict:
+
+    """
+    The EMF record of the request, None if metrics are off - for log.finish to print
+    """
+
+    request = _request.get()
+    if request is None:
+        return None
+
+    _request.set(None)
+
+    with request["lock"]:
+        spans = dict(request["spans"])
+        values = dict(request["values"])
+
+    record = {
+        "Route": request["route"] or "Unknown",
+        "DurationMs": round((time.perf_counter() - request["started"]) * 1000, 3)
+    }
+    metrics = [{"Name": "DurationMs", "Unit": "Milliseconds"}]
+
+    for name, elapsed in spans.items():
+        record[f"{name}Ms"] = round(elapsed, 3)
+        metrics.append({"Name": f"{name}Ms", "Unit": "Milliseconds"})
+
+    for name, value in values.items():
+        record[name] = value
+        metrics.append({"Name": name, "Unit": "Count"})
+
+    record.update(request["properties"])
+    record.update(properties)
+    record["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": namespace,
+            "Dimensions": [["Route"]],
+            "Metrics": metrics
+        }]
+    }
+
+    return record
+
+
+def profile(function, *args):
+
+    """
+    Call function, under cProfile for a sampled share of the requests
+    """
+
+    if not profile_sample_rate or random.random() >= profile_sample_rate:
+        return function(*args)
+
+    # Only sampled requests pay for importing the profiler
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream = output).sort_stats("cumulative").print_stats(profile_top)
+
+        request = _request.get()
+        print(json.dumps({
+            "route": request["route"] if request else None,
+            "requestId": request["properties"].get("requestId") if request else None,
+            "profile": output.getvalue()
+        }))
@@ -0,0 +1,66 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+"""
+Compact post model - the one shape of a post in every response
+
+Posts are built straight from the low-level client's wire format ({"S": "..."}), without
+the resource layer's TypeDeserializer and without an intermediate dict per item. With
+slots there is no __dict__ per post either. orjson serializes the dataclass natively and
+leaves out fields starting with an underscore, so the userId never reaches the client.
+"""
+
+
+@dataclass(slots = True)
+class Post:
+    postId: str
+    author: str
+    text: str
+    time: str
+    _userId: str
+    canDelete: Optional[bool] = None
+
+
+    @classmethod
+    def from_item(cls, item: dict, author: str = None) -> "Post":
+
+        """
+        author is filled in by the caller if it was not projected, e.g. on a page of one author's posts
+        """
+
+        return cls(
+            item["postId"]["S"],
+            item["author"]["S"] if "author" in item else author,
+            item["text"]["S"] if "text" in item else "",
+            item["time"]["S"],
+            item["userId"]["S"]
+        )
+
+
+    @classmethod
+    def from_record(cls, item: dict) -> "Post":
+
+        """
+        From an item with plain values, as the Table resource reads and writes them - e.g. a post just created
+        """
+
+        return cls(item["postId"], item["author"], item.get("text", ""), item["time"], item["userId"])
+
+
+    # Mapping-style access, so the post can be authorized and cached like an item dict
+
+    def get(self, name, default = None):
+        return getattr(self, FIELDS.get(name, name), default)
+
+
+    def __getitem__(self, name):
+        return getattr(self, FIELDS.get(name, name))
+
+
+    def __setitem__(self, name, value):
+        setattr(self, FIELDS.get(name, name), value)
+
+
+# Table attribute -> field
+FIELDS = {"userId": "_userId"}
@@ -1,11 +1,59 @@
-import boto3
+import hashlib
 import os
+import time
 
 from typing import Optional
 
-avp_client = boto3.client("verifiedpermissions")
+import cache
+import cedar
+import clients
+import log
+import metrics
+import plans
+import resilience
+import tokens
+
 policy_store_id = os.environ.get("PolicyStoreId")
 
+# BatchIsAuthorizedWithToken accepts at most 30 requests per call
+batch_size = 30
+
+# Decisions are cached per container, an entry never outlives the identity token it was made for
+decision_cache = cache.LRUCache(int(os.environ.get("DecisionCacheSize", "1024")))
+decision_cache_ttl = int(os.environ.get("DecisionCacheTtl", "300"))
+
+# Identical checks that are already on their way to AVP are not sent a second time
+in_flight = cache.SingleFlight()
+
+# AVP calls go through a circuit breaker that denies while AVP is unhealthy, single checks are hedged past a latency percentile
+avp = resilience.ResilientCall(
+    "Avp",
+    failure_threshold = int(os.environ.get("AvpBreakerFailures", "5")),
+    cooldown = float(os.environ.get("AvpBreakerCooldown", "10")),
+    hedge = os.environ.get("AvpHedge", "true").lower() == "true",
+    hedge_percentile = float(os.environ.get("AvpHedgePercentile", "95")),
+    hedge_min_delay = float(os.environ.get("AvpHedgeMinDelayMs", "10")) / 1000,
+    hedge_budget = float(os.environ.get("AvpHedgeBudget", "0.1"))
+)
+
+# remote: AVP decides, shadow: AVP decides and the local engine is compared against it, local: the local engine decides
+policy_evaluation = os.environ.get("PolicyEvaluation", "remote").lower()
+policy_directory = plans.policy_directory
+
+policy_set = None
+shadow_stats = {"compared": 0, "mismatches": 0}
+
+if policy_evaluation in ("shadow", "local"):
+    try:
+        policy_set = cedar.PolicySet.from_directory(policy_directory)
+    except (cedar.CedarError, OSError) as e:
+        log.warning("Local policy engine unavailable, falling back to AVP", error = str(e))
+        policy_evaluation = "remote"
+
+if policy_evaluation == "local" and not tokens.verification_configured():
+    log.warning("Local policy engine needs UserPoolIssuer and UserPoolClientId to verify tokens, falling back to AVP")
+    policy_evaluation = "remote"
+
 
 def format_entity(entity_type, entity_id):
     return {"entityType": f"SimplePosts::{entity_type}", "entityId": entity_id}
@@ -15,13 +63,186 @@ def format_action(action_id):
     return {"actionType": "SimplePosts::Action", "actionId": action_id}
 
 
+def principal_cache_key(token: str) -> tuple:
+
+    """
+    Identify the principal behind the identity token for the decision cache - returns
+    (None, None) if decisions for this token must not be cached
+    """
+
+    if not token or decision_cache_ttl <= 0:
+        return None, None
+
+    try:
+        claims = tokens.identity_claims(token, verify = False)
+    except tokens.TokenError:
+        return None, None
+
+    now = time.time()
+    exp = claims.get("exp")
+
+    if not exp or exp <= now:
+        return None, None
+
+    principal = (claims.get("iss"), claims.get("sub"), claims.get("custom:appRole"))
+
+    # The token digest keeps a forged token with copied claims from reusing a decision AVP made for the real one
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+
+    return (principal, token_digest), min(exp, now + decision_cache_ttl)
+
+
+def resource_cache_key(plan: plans.Plan, resource: Optional[dict]) -> tuple:
+    if plan.resource_type == plans.APPLICATION or not resource:
+        return (plans.APPLICATION, "app", None)
+
+    return (plan.resource_type, resource.get("postId"), tuple(resource.get(column) for column in plan.columns))
+
+
+def format_attribute(definition: dict, value) -> dict:
+    if definition.get("type") == "Entity":
+        return {"entityIdentifier": format_entity(definition["name"], value)}
+
+    if definition.get("type") == "Long":
+        return {"long": int(value)}
+
+    if definition.get("type") == "Boolean":
+        return {"boolean": bool(value)}
+
+    return {"string": str(value)}
+
+
+def format_resource_entity(plan: plans.Plan, item: dict) -> dict:
+
+    """
+    The resource entity with the attributes the policies for the plan's action reference
+    """
+
+    attributes = {}
+
+    for name, definition in plan.attributes.items():
+        value = item.get(plans.column(plan.resource_type, name))
+
+        if value is not None:
+            attributes[name] = format_attribute(definition, value)
+
+    return {
+        "identifier": format_entity(plan.resource_type, item.get("postId")),
+        "attributes": attributes
+    }
+
+
+def principal_entity(claims: dict) -> tuple:
+
+    """
+    Map identity token claims to a User entity the way the AVP Cognito identity source does
+    """
+
+    principal = cedar.Entity("SimplePosts::User", f"{claims.get('iss').split('/')[3]}|{claims.get('sub')}")
+    attributes = {}
+
+    for claim, value in claims.items():
+        if claim.startswith("custom:"):
+            attributes.setdefault("custom", {})[claim[len("custom:"):]] = value
+        elif ":" not in claim and isinstance(value, (str, int, bool)):
+            attributes[claim] = value
+
+    return principal, attributes
+
+
+def evaluate_locally(claims: dict, action: str, resource: Optional[dict]) -> str:
+    principal, attributes = principal_entity(claims)
+    entities = {principal: {"attrs": attributes}}
+    requested_resource = cedar.Entity("SimplePosts::Application", "app")
+    plan = plans.plan_for(action)
+
+    if resource and plan.resource_type != plans.APPLICATION:
+        requested_resource = cedar.Entity(f"SimplePosts::{plan.resource_type}", resource.get("postId"))
+        resource_attributes = {}
+
+        for name, definition in plan.attributes.items():
+            value = resource.get(plans.column(plan.resource_type, name))
+
+            if value is None:
+                continue
+
+            if definition.get("type") == "Entity":
+                value = cedar.Entity(f"SimplePosts::{definition['name']}", value)
+
+            resource_attributes[name] = value
+
+        entities[requested_resource] = {"attrs": resource_attributes}
+
+    result = policy_set.is_authorized(
+        principal,
+        cedar.Entity("SimplePosts::Action", action),
+        requested_resource,
+        entities
+    )
+
+    return result.decision
+
+
+def local_decisions(token: str, action: str, resources: list) -> list:
+
+    """
+    AVP verifies the identity token itself - the local engine only gets to decide on verified claims
+    """
+
+    try:
+        claims = tokens.identity_claims(token)
+    except tokens.TokenError as e:
+        log.warning("Local permission check rejected token", error = str(e))
+        return ["DENY"] * len(resources)
+
+    with metrics.span("LocalEvaluation"):
+        return [evaluate_locally(claims, action, resource) for resource in resources]
+
+
+def compare_decision(token: str, action: str, resource: Optional[dict], avp_decision: str):
+
+    """
+    Shadow mode - never changes the outcome, only records where the local engine disagrees with AVP
+    """
+
+    try:
+        decision = evaluate_locally(tokens.identity_claims(token, verify = False), action, resource)
+    except Exception as e:
+        decision = f"ERROR {e}"
+
+    shadow_stats["compared"] += 1
+
+    if decision != avp_decision:
+        shadow_stats["mismatches"] += 1
+        log.warning(
+            "Shadow mismatch",
+            action = action,
+            resource = resource_cache_key(plans.plan_for(action), resource),
+            avpDecision = avp_decision,
+            localDecision = decision,
+            shadowStats = dict(shadow_stats)
+        )
+
+
 def check_permission(token: str, action: str, resource:Optional[dict]) -> bool:
 
+    if policy_evaluation == "local":
+        return local_decisions(token, action, [resource])[0]
+
+    plan = plans.plan_for(action)
+    principal_key, cache_expiry = principal_cache_key(token)
+    cache_key = (principal_key, action, resource_cache_key(plan, resource)) if principal_key else None
+
+    if cache_key:
+        decision = decision_cache.get(cache_key)
+
+        if decision:
+            log.debug("Decision cache hit", decision = decision, cacheStats = decision_cache.stats)
+            metrics.add("DecisionCacheHits", 1)
+            return decision
+
     user_action = format_action(action)
     requested_resource = format_entity("Application", "app")
-    print("PERMISSION CHECK:")
-    print(f"ACTION {user_action}")
-    print(f"DEFAULT RESOURCE: {requested_resource}")
 
     args = {
         "policyStoreId": policy_store_id,
@@ -29,29 +250,149 @@ def check_permission(token: str, action: str, resource:Optional[dict]) -> bool:
         "action": user_action,
         "resource": requested_resource
     }
-    print(f"DEFAULT ARGS: {args}")
 
-    if resource:
-        requested_resource = format_entity("Post", resource.get("postId"))
+    if resource and plan.resource_type != plans.APPLICATION:
+        requested_resource = format_entity(plan.resource_type, resource.get("postId"))
         entities = {
-            "entityList": [
-                {
-                    "identifier": requested_resource,
-                    "attributes": {
-                        "owner": {
-                            "entityIdentifier": format_entity("User", resource.get("userId"))
-                        }
-                    }
-                }
-            ]
+            "entityList": [format_resource_entity(plan, resource)]
         }
         args["entities"] = entities
 
         args["resource"] = requested_resource
-        print(f"ARGS WITH RESOURCE: {args}")
 
-    avp_response = avp_client.is_authorized_with_token(**args)
+    log.debug("Permission check", args = args)
+
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    try:
+        with metrics.span("AvpIsAuthorized"):
+            if cache_key:
+                avp_response = in_flight.do(cache_key, is_authorized_with_token, args)
+            else:
+                avp_response = is_authorized_with_token(args)
+    except resilience.CircuitOpen:
+        # Fail closed, and do not cache it - the decision is not AVP's
+        log.warning("AVP unavailable, denying", action = action)
+        return "DENY"
+    except (BotoCoreError, ClientError) as e:
+        # Any other failure to get a decision fails closed the same way
+        log.warning("AVP check failed, denying", action = action, error = type(e).__name__)
+        return "DENY"
+
+    log.debug("AVP response", response = avp_response)
+
+    decision = avp_response.get("decision")
+
+    if policy_evaluation == "shadow":
+        compare_decision(token, action, resource, decision)
+
+    if cache_key and decision:
+        decision_cache.put(cache_key, decision, cache_expiry)
+
+    return decision
+
+
+def is_authorized_with_token(args: dict) -> dict:
+    return avp.call(clients.verified_permissions().is_authorized_with_token, **args)
+
+
+def check_permissions_batch(token: str, action: str, posts: list) -> list:
+
+    """
+    Authorize one action against a page of posts - posts not in the decision cache are sent
+    to AVP in chunks of up to 30, returns one decision per post in the same order
+    """
+
+    if policy_evaluation == "local":
+        return local_decisions(token, action, posts)
+
+    plan = plans.plan_for(action)
+    principal_key, cache_expiry = principal_cache_key(token)
+    decisions = [None] * len(posts)
+    pending = []
+
+    for index, post in enumerate(posts):
+        cache_key = (principal_key, action, resource_cache_key(plan, post)) if principal_key else None
+        decision = decision_cache.get(cache_key) if cache_key else None
+
+        if decision:
+            decisions[index] = decision
+        else:
+            pending.append((index, cache_key))
+
+    log.debug("Batch permission check", action = action, posts = len(posts), notCached = len(pending))
+
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        chunk_posts = [posts[index] for index, _ in chunk]
+
+        try:
+            with metrics.span("AvpBatchIsAuthorized"):
+                avp_response = avp.call(
+                    clients.verified_permissions().batch_is_authorized_with_token,
+                    hedge = False,
+                    policyStoreId = policy_store_id,
+                    identityToken = token,
+                    entities = {
+                        "entityList": [format_resource_entity(plan, post) for post in chunk_posts]
+                    },
+                    requests = [
+                        {
+                            "action": format_action(action),
+                            "resource": format_entity(plan.resource_type, post.get("postId"))
+                        } for post in chunk_posts
+                    ]
+                )
+        except resilience.CircuitOpen:
+            # Fail closed for every post not decided yet, nothing of it is cached
+            log.warning("AVP unavailable, denying", action = action, posts = len(pending) - start)
+            for index, _ in pending[start:]:
+                decisions[index] = "DENY"
+            break
+        except (BotoCoreError, ClientError) as e:
+            # The same for this chunk only, the next one may get through
+            log.warning("AVP batch check failed, denying", action = action, posts = len(chunk), error = type(e).__name__)
+            for index, _ in chunk:
+                decisions[index] = "DENY"
+            continue
+
+        results = {
+            result["request"]["resource"]["entityId"]: result.get("decision")
+            for result in avp_response.get("results", [])
+        }
+
+        for index, cache_key in chunk:
+            decision = results.get(posts[index].get("postId"))
+
+            if not decision:
+                # AVP did not decide on this post - denied, but not remembered as AVP's decision
+                decisions[index] = "DENY"
+                continue
+
+            decisions[index] = decision
+
+            if policy_evaluation == "shadow":
+                compare_decision(token, action, posts[index], decision)
+
+            if cache_key:
+                decision_cache.put(cache_key, decision, cache_expiry)
+
+    return decisions
+
+
+def annotate_posts(token: str, action: str, posts: list, flag: str) -> list:
+
+    """
+    Set a boolean flag on every post telling the client whether the action would be allowed,
+    e.g. "canDelete" so the front-end knows which delete buttons to render
+    """
+
+    if not posts:
+        return posts
 
-    print(f"FULL AVP RESPONSE: {avp_response}")
+    for post, decision in zip(posts, check_permissions_batch(token, action, posts)):
+        post[flag] = decision == "ALLOW"
 
-    return avp_response.get("decision")
+    return posts
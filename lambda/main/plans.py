@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+
+from collections import namedtuple
+
+import cedar
+import database
+import log
+
+
+"""
+Authorization plans - what has to be fetched before an action can be authorized
+
+A plan is derived once per container from cdk/policy_store: the resource type comes from
+the action's appliesTo in schema.json, the attributes are the resource attributes the
+policies for the action reference and the schema declares. Each attribute maps to a
+column of the posts table, so the handler fetches exactly those columns (plus the keys)
+and nothing at all for actions on the Application.
+
+Without the policy store the plans fall back to the entities the policies were written for.
+"""
+
+
+policy_directory = os.environ.get(
+    "PolicyDirectory",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "cdk", "policy_store")
+)
+
+Plan = namedtuple("Plan", ["action", "resource_type", "attributes", "columns"])
+
+APPLICATION = "Application"
+
+# Cedar attribute -> table column, attributes not listed here use a column of the same name
+ATTRIBUTE_COLUMNS = {
+    "Post": {"owner": "userId"}
+}
+
+FALLBACK_PLANS = {
+    "DeletePost": Plan("DeletePost", "Post", {"owner": {"type": "Entity", "name": "User"}}, database.KEY_COLUMNS)
+}
+
+_plans = None
+_lock = threading.Lock()
+
+
+def column(resource_type, attribute) -> str:
+    return ATTRIBUTE_COLUMNS.get(resource_type, {}).get(attribute, attribute)
+
+
+def build_plans(policy_set) -> dict:
+    schema = policy_set.schema[policy_set.namespace]
+    entity_types = schema.get("entityTypes", {})
+    plans = {}
+
+    for action_id, definition in schema.get("actions", {}).items():
+        resource_types = definition.get("appliesTo", {}).get("resourceTypes") or [APPLICATION]
+
+        # Actions in this app apply to one resource type - a Post if any, as that needs a lookup
+        resource_type = next((name for name in resource_types if name != APPLICATION), APPLICATION)
+
+        if resource_type == APPLICATION:
+            plans[action_id] = Plan(action_id, APPLICATION, {}, database.KEY_COLUMNS)
+            continue
+
+        declared = entity_types.get(resource_type, {}).get("shape", {}).get("attributes", {})
+        referenced = policy_set.referenced_attributes(policy_set.action_entity(action_id))
+        attributes = {name: declared[name] for name in sorted(referenced) if name in declared}
+
+        columns = list(database.KEY_COLUMNS)
+        for name in attributes:
+            if column(resource_type, name) not in columns:
+                columns.append(column(resource_type, name))
+
+        plans[action_id] = Plan(action_id, resource_type, attributes, tuple(columns))
+
+    return plans
+
+
+def load_plans() -> dict:
+    try:
+        policy_set = cedar.PolicySet.from_directory(policy_directory)
+        if not policy_set.schema:
+            raise cedar.CedarError(f"No schema.json in {policy_directory}")
+
+        plans = build_plans(policy_set)
+    except (cedar.CedarError, OSError, json.JSONDecodeError) as e:
+        log.warning("Policy store unavailable, using the fallback authorization plans", error = str(e))
+        return dict(FALLBACK_PLANS)
+
+    log.debug("Authorization plans", plans = lambda: {action: plan._asdict() for action, plan in plans.items()})
+
+    return plans
+
+
+def plan_for(action) -> Plan:
+    global _plans
+
+    if _plans is None:
+        with _lock:
+            if _plans is None:
+                _plans = load_plans()
+
+    return _plans.get(action) or Plan(action, APPLICATION, {}, database.KEY_COLUMNS)
@@ -0,0 +1,120 @@
+import json
+import math
+import os
+import threading
+import time
+
+import cache
+import clients
+import log
+
+
+"""
+Admission control per principal and action
+
+Every (userid, action) pair has a token bucket in the container: it refills at RateLimitRate
+tokens per second up to RateLimitBurst, every request takes one. RateLimits overrides both
+per action, e.g. {"BatchDeletePosts": {"rate": 0.5, "burst": 2}}. Without a rate there is no limit.
+
+Buckets in memory only see the requests of one container. With RateLimitTable set, requests
+a bucket lets through are also counted in a DynamoDB table shared by all containers - one
+conditional update per request on a counter per RateLimitWindow seconds, which admits
+rate * window + burst requests per window. If the table cannot be reached, requests are
+let through - the limiter protects the quotas, it must not take the API down.
+
+The table needs a string partition key "bucket" and TTL on the "expires" attribute.
+"""
+
+
+default_rate = float(os.environ.get("RateLimitRate", "0"))
+default_burst = float(os.environ.get("RateLimitBurst", "0"))
+action_limits = json.loads(os.environ.get("RateLimits", "{}"))
+shared_table_name = os.environ.get("RateLimitTable")
+shared_window = int(os.environ.get("RateLimitWindow", "10"))
+
+buckets = cache.LRUCache(int(os.environ.get("RateLimitBuckets", "10000")))
+_lock = threading.Lock()
+
+
+def limit_for(action) -> tuple:
+
+    """
+    (rate, burst) for an action, None if it is not limited
+    """
+
+    limits = action_limits.get(action, {})
+    rate = float(limits.get("rate", default_rate))
+    burst = float(limits.get("burst", default_burst)) or max(rate, 1.0)
+
+    if rate <= 0:
+        return None
+
+    return rate, burst
+
+
+def take_local(key, rate, burst, now) -> float:
+
+    """
+    Take a token from the bucket - returns 0 if there was one, otherwise the seconds until there is
+    """
+
+    with _lock:
+        tokens, updated = buckets.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+
+        if tokens >= 1:
+            buckets.put(key, (tokens - 1, now))
+            return 0.0
+
+        buckets.put(key, (tokens, now))
+
+        return (1 - tokens) / rate
+
+
+def take_shared(key, rate, burst, now) -> float:
+    window = int(now // shared_window)
+    table = clients.table(shared_table_name)
+
+    try:
+        table.update_item(
+            Key = {"bucket": f"{key[0]}#{key[1]}#{window}"},
+            UpdateExpression = "ADD hits :one SET expires = :expires",
+            ConditionExpression = "attribute_not_exists(hits) OR hits < :limit",
+            ExpressionAttributeValues = {
+                ":one": 1,
+                ":limit": math.ceil(rate * shared_window + burst),
+                ":expires": (window + 2) * shared_window
+            }
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return (window + 1) * shared_window - now
+    except Exception as e:
+        log.warning("Shared rate limit unavailable, admitting request", error = str(e))
+
+    return 0.0
+
+
+def admit(userid, action) -> tuple:
+
+    """
+    Returns (admitted, seconds to wait before retrying)
+    """
+
+    limit = limit_for(action)
+    if limit is None:
+        return True, 0
+
+    rate, burst = limit
+    key = (userid, action)
+    now = time.time()
+
+    wait = take_local(key, rate, burst, now)
+
+    if not wait and shared_table_name:
+        wait = take_shared(key, rate, burst, now)
+
+    if wait:
+        log.info("Rate limited", userid = userid, action = action, retryAfter = round(wait, 3))
+        return False, max(1, math.ceil(wait))
+
+    return True, 0
@@ -0,0 +1,208 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+import cache
+import log
+import metrics
+
+
+"""
+Versioned read cache for the pages of GET /posts?author=...
+
+Every author has a version that is bumped after each write to their posts. Pages are
+cached under the version they were read at, so a write makes all cached pages of that
+author unreachable at once - nothing is guessed with a TTL. The version read before a
+query also makes the page's ETag.
+
+The author_postid_index is eventually consistent, a query right after a write may not
+see it yet. A version therefore carries the time it was bumped at, and for the first
+ReadCacheGrace seconds pages read at it are neither cached nor given an ETag.
+
+ReadCache selects the store:
+- off (default): no caching
+- memory: per process, exact within it - for the container server, not for Lambda,
+  where every container has its own versions
+- redis: shared by all processes through ReadCacheUrl (any Redis-compatible store),
+  needs the redis package
+"""
+
+
+mode = os.environ.get("ReadCache", "off").lower()
+cache_size = int(os.environ.get("ReadCacheSize", "1024"))
+cache_ttl = int(os.environ.get("ReadCacheTtl", "3600"))
+cache_url = os.environ.get("ReadCacheUrl", "redis://localhost:6379/0")
+cache_grace = float(os.environ.get("ReadCacheGrace", "2"))
+
+
+class MemoryStore:
+
+    def __init__(self, maxsize):
+        self.pages = cache.LRUCache(maxsize)
+        self.versions = cache.LRUCache(maxsize * 4)
+
+        # Versions come from one counter, so an author whose version was evicted never gets an old one back
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+
+    def version(self, author) -> str:
+        with self._lock:
+            version = self.versions.get(author)
+
+            if version is None:
+                # Unknown or evicted - a write may have just happened, so the version counts as just bumped
+                version = new_version(next(self._counter))
+                self.versions.put(author, version)
+
+        return version
+
+
+    def bump(self, author):
+        with self._lock:
+            self.versions.put(author, new_version(next(self._counter)))
+
+
+    def get(self, key):
+        return self.pages.get(key)
+
+
+    def put(self, key, page):
+        self.pages.put(key, page)
+
+
+class RedisStore:
+
+    def __init__(self, url, ttl):
+        # Imported here, only the redis mode needs the package
+        import redis
+
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url, socket_timeout = 0.1, socket_connect_timeout = 0.1)
+
+
+    def version(self, author) -> str:
+        version = self.client.get(f"version:{author}")
+
+        if version is None:
+            # Unknown or evicted - a new random version, so pages cached under an old one stay unreachable
+            self.client.set(f"version:{author}", new_version(uuid.uuid4().hex), nx = True)
+            version = self.client.get(f"version:{author}")
+
+        return version.decode()
+
+
+    def bump(self, author):
+        self.client.set(f"version:{author}", new_version(uuid.uuid4().hex))
+
+
+    def get(self, key):
+        page = self.client.get(f"page:{key}")
+
+        return json.loads(page) if page else None
+
+
+    def put(self, key, page):
+        self.client.set(f"page:{key}", json.dumps(page, separators = (",", ":")), ex = self.ttl)
+
+
+store = None
+
+if mode == "memory":
+    store = MemoryStore(cache_size)
+elif mode == "redis":
+    try:
+        store = RedisStore(cache_url, cache_ttl)
+    except ImportError:
+        log.warning("ReadCache is redis, but the redis package is not installed - read cache disabled")
+
+
+def enabled() -> bool:
+    return store is not None
+
+
+def new_version(unique) -> str:
+    return f"{unique}@{int(time.time() * 1000)}"
+
+
+def settled(version) -> bool:
+
+    """
+    Whether the write that made the version has had time to reach the author_postid_index
+    """
+
+    return time.time() * 1000 - int(version.rsplit("@", 1)[1]) >= cache_grace * 1000
+
+
+def page_key(author, version, limit, cursor, bounds = None) -> str:
+
+    """
+    bounds are the before and after of a page that has them
+    """
+
+    return hashlib.sha256(json.dumps([author, version, limit, cursor, bounds]).encode()).hexdigest()
+
+
+def version(author):
+
+    """
+    The author's current version, None without a cache or if the store is unreachable
+    """
+
+    if store is None:
+        return None
+
+    try:
+        return store.version(author)
+    except Exception as e:
+        log.warning("Read cache unavailable", error = str(e))
+        return None
+
+
+def bump(author):
+    if store is None or not author:
+        return
+
+    try:
+        store.bump(author)
+    except Exception as e:
+        # Pages cached under the old version stay reachable until the next successful bump
+        log.error("Read cache version bump failed", author = author, error = str(e))
+
+
+def get(author, version, limit, cursor, bounds = None):
+    if version is None:
+        return None
+
+    try:
+        page = store.get(page_key(author, version, limit, cursor, bounds))
+    except Exception as e:
+        log.warning("Read cache unavailable", error = str(e))
+        page = None
+
+    metrics.add("ReadCacheHits" if page else "ReadCacheMisses", 1)
+
+    return page
+
+
+def put(author, version, limit, cursor, page, bounds = None):
+    if version is None or not settled(version):
+        return
+
+    try:
+        store.put(page_key(author, version, limit, cursor, bounds), page)
+    except Exception as e:
+        log.warning("Read cache unavailable", error = str(e))
+
+
+def etag(author, version, limit, cursor, viewer, bounds = None) -> str:
+
+    """
+    Weak ETag for a page as one viewer sees it - canDelete depends on who is asking
+    """
+
+    return f'W/"{page_key(author, version, limit, [cursor, viewer], bounds)[:32]}"'
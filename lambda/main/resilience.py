@@ -0,0 +1,283 @@
+import collections
+import contextvars
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import log
+import metrics
+
+
+"""
+Circuit breaker and hedged requests for calls to a downstream service
+
+The breaker opens after a number of consecutive failures - throttles, server errors,
+timeouts - and rejects calls with CircuitOpen until the cooldown has passed. Then one
+call is let through as a probe, it closes the breaker again or reopens it. Callers
+decide what a rejected call means, for authorization that is a DENY.
+
+A hedged call sends a second, identical request if the first has not returned after
+the given percentile of recent latencies, and takes whichever answers first. Hedges
+are paid for from a budget that every call adds a fraction of a hedge to, so a slow
+service gets at most that share of extra requests.
+
+Every decision is counted in metrics as <name>Hedged, <name>HedgeWins, <name>Failures,
+<name>CircuitOpened, <name>CircuitOpen (rejected calls) and <name>Retries.
+"""
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold = 5, cooldown = 10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self._probing = False
+
+            if self.state == CLOSED:
+                return True
+
+            # Half open - exactly one call finds out whether the service is back
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                log.warning("Circuit closed", circuit = self.name)
+
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                log.warning("Circuit opened", circuit = self.name, failures = self.failures)
+                metrics.add(f"{self.name}CircuitOpened", 1)
+
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class LatencyWindow:
+
+    """
+    The latencies of the last calls, with a percentile recomputed every few samples
+    """
+
+    def __init__(self, size = 256, min_samples = 50, refresh = 16):
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._samples = collections.deque(maxlen = size)
+        self._recorded = 0
+        self._percentiles = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._recorded += 1
+
+            if self._recorded % self.refresh == 0:
+                self._percentiles = {}
+
+
+    def percentile(self, p):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+
+            if p not in self._percentiles:
+                samples = sorted(self._samples)
+                self._percentiles[p] = samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+            return self._percentiles[p]
+
+
+class ResilientCall:
+
+    def __init__(
+        self,
+        name,
+        failure_threshold = 5,
+        cooldown = 10.0,
+        hedge = True,
+        hedge_percentile = 95.0,
+        hedge_min_delay = 0.01,
+        hedge_budget = 0.1,
+        workers = 16
+    ):
+        self.name = name
+        self.breaker = CircuitBreaker(name, failure_threshold, cooldown)
+        self.latencies = LatencyWindow()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = hedge_budget
+        self.workers = workers
+
+        # Up to ten hedges can be saved up for a burst of slow calls
+        self._budget = 0.0
+        self._budget_cap = 10.0
+        self._executor = None
+        self._lock = threading.Lock()
+
+
+    def call(self, function, *args, hedge = True, **kwargs):
+
+        """
+        Call function(*args, **kwargs) through the breaker, hedged if hedge and the
+        service has a latency history - raises CircuitOpen without calling it while
+        the breaker is open. Only calls of the same kind should be hedged, their
+        latencies make the threshold.
+        """
+
+        if not self.breaker.allow():
+            metrics.add(f"{self.name}CircuitOpen", 1)
+            raise CircuitOpen(f"{self.name} circuit is open")
+
+        try:
+            if hedge and self.hedge:
+                response = self.hedged(function, *args, **kwargs)
+            else:
+                response = function(*args, **kwargs)
+        except Exception as e:
+            if unhealthy(e):
+                metrics.add(f"{self.name}Failures", 1)
+                self.breaker.failure()
+            else:
+                # The service answered, the request was wrong
+                self.breaker.success()
+            raise
+
+        self.breaker.success()
+
+        retries = response.get("ResponseMetadata", {}).get("RetryAttempts") if isinstance(response, dict) else None
+        if retries:
+            metrics.add(f"{self.name}Retries", retries)
+
+        return response
+
+
+    def hedged(self, function, *args, **kwargs):
+        delay = self.hedge_delay()
+
+        if delay is None:
+            # Not enough history yet - the call runs inline and becomes part of it
+            return self.timed(function, *args, **kwargs)
+
+        primary = self.submit(function, *args, **kwargs)
+        done, _ = wait([primary], timeout = delay)
+
+        if done or not self.take_hedge():
+            return primary.result()
+
+        metrics.add(f"{self.name}Hedged", 1)
+        hedge = self.submit(function, *args, **kwargs)
+        pending = {primary, hedge}
+        error = None
+
+        # The first answer wins, an error only counts once the other request failed too
+        while pending:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.add(f"{self.name}HedgeWins", 1)
+
+                    return future.result()
+
+                error = future.exception()
+
+        raise error
+
+
+    def hedge_delay(self):
+        threshold = self.latencies.percentile(self.hedge_percentile)
+
+        if threshold is None:
+            return None
+
+        return max(threshold, self.hedge_min_delay)
+
+
+    def take_hedge(self) -> bool:
+        with self._lock:
+            if self._budget >= 1:
+                self._budget -= 1
+                return True
+
+            return False
+
+
+    def timed(self, function, *args, **kwargs):
+        started = time.perf_counter()
+        response = function(*args, **kwargs)
+
+        # Every call adds to the hedge budget, and only successful calls make the latency history
+        self.latencies.record(time.perf_counter() - started)
+
+        with self._lock:
+            self._budget = min(self._budget_cap, self._budget + self.hedge_budget)
+
+        return response
+
+
+    def submit(self, function, *args, **kwargs):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers = self.workers)
+
+        # A context can only be entered by one thread at a time, so every request gets its own copy
+        return self._executor.submit(contextvars.copy_context().run, self.timed, function, *args, **kwargs)
+
+
+def unhealthy(error) -> bool:
+
+    """
+    Whether an error says something about the service rather than the request - anything
+    without a response (timeouts, connection errors), throttles and server errors
+    """
+
+    response = getattr(error, "response", None)
+
+    if not isinstance(response, dict):
+        return True
+
+    status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+    code = response.get("Error", {}).get("Code")
+
+    return status_code >= 500 or status_code == 429 or code in ("ThrottlingException", "TooManyRequestsException")
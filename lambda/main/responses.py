@@ -0,0 +1,155 @@
+import base64
+import dataclasses
+import decimal
+import gzip
+import importlib
+import json
+import os
+
+
+"""
+Response pipeline for every route
+
+Bodies are serialized with orjson when it is installed and with the json module
+otherwise. Bodies above CompressionThreshold bytes are compressed with brotli or
+gzip if the client accepts it, and base64-encoded as API Gateway expects for
+binary bodies. orjson and brotli are imported with the first response that needs
+them, not with the module.
+"""
+
+
+compression_threshold = int(os.environ.get("CompressionThreshold", "1024"))
+gzip_level = int(os.environ.get("GzipLevel", "6"))
+brotli_quality = int(os.environ.get("BrotliQuality", "5"))
+
+DEFAULT_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*"
+}
+
+
+# Optional modules by name, None once known not to be installed
+_optional = {}
+
+
+def optional(name):
+    if name not in _optional:
+        try:
+            _optional[name] = importlib.import_module(name)
+        except ImportError:
+            _optional[name] = None
+
+    return _optional[name]
+
+
+def encode_default(value):
+    # DynamoDB returns numbers as Decimal
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+
+    # Same as orjson does natively - fields starting with an underscore are private
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return {field.name: getattr(value, field.name) for field in dataclasses.fields(value) if not field.name.startswith("_")}
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(body) -> str:
+    orjson = optional("orjson")
+
+    if orjson:
+        return orjson.dumps(body, default = encode_default).decode()
+
+    return json.dumps(body, default = encode_default)
+
+
+def format_response(body, status_code = 200, headers = None) -> dict:
+    response_headers = dict(DEFAULT_HEADERS)
+    if headers:
+        response_headers.update(headers)
+
+    return {
+        "statusCode": status_code,
+        "headers": response_headers,
+        "body": dumps(body)
+    }
+
+
+def not_modified(headers = None) -> dict:
+    response_headers = {"Access-Control-Allow-Origin": "*"}
+    if headers:
+        response_headers.update(headers)
+
+    return {
+        "statusCode": 304,
+        "headers": response_headers,
+        "body": ""
+    }
+
+
+def accepted_encodings(accept_encoding) -> dict:
+
+    """
+    Parse an Accept-Encoding header into {coding: quality}, e.g. "gzip, br;q=0.5"
+    """
+
+    encodings = {}
+
+    for part in (accept_encoding or "").split(","):
+        coding, _, parameters = part.strip().partition(";")
+        quality = 1.0
+
+        if parameters.strip().startswith("q="):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                quality = 0.0
+
+        if coding:
+            encodings[coding.strip().lower()] = quality
+
+    return encodings
+
+
+def choose_encoding(accept_encoding):
+    encodings = accepted_encodings(accept_encoding)
+    candidates = ["br", "gzip"] if optional("brotli") else ["gzip"]
+
+    def quality(coding):
+        return encodings.get(coding, encodings.get("*", 0.0))
+
+    accepted = [coding for coding in candidates if quality(coding) > 0]
+    if not accepted:
+        return None
+
+    # Prefer the server's order among equally weighted encodings
+    return max(accepted, key = lambda coding: (quality(coding), -candidates.index(coding)))
+
+
+def compress(response: dict, accept_encoding) -> dict:
+    body = response.get("body")
+
+    if not body or response.get("isBase64Encoded") or len(body) < compression_threshold:
+        return response
+
+    encoding = choose_encoding(accept_encoding)
+    if not encoding:
+        return response
+
+    data = body.encode()
+
+    if encoding == "br":
+        compressed = optional("brotli").compress(data, quality = brotli_quality)
+    else:
+        compressed = gzip.compress(data, compresslevel = gzip_level, mtime = 0)
+
+    headers = dict(response.get("headers") or {})
+    headers["Content-Encoding"] = encoding
+    headers["Vary"] = "Accept-Encoding"
+
+    compressed_response = dict(response)
+    compressed_response["headers"] = headers
+    compressed_response["body"] = base64.b64encode(compressed).decode()
+    compressed_response["isBase64Encoded"] = True
+
+    return compressed_response
@@ -0,0 +1,192 @@
+import base64
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# A container serves many requests at once, keep enough connections open to AVP and DynamoDB
+os.environ.setdefault("MaxPoolConnections", "50")
+os.environ.setdefault("ConcurrentReads", "true")
+
+# One process serves all requests, so the in-memory read cache is exact
+os.environ.setdefault("ReadCache", "memory")
+
+# No API Gateway JWT authorizer in front of the server - every token has to be verified here
+os.environ["RequireTokenVerification"] = "true"
+
+import actions
+import main
+import tokens
+
+
+"""
+Long running HTTP server for the function code, e.g. in a container
+
+Every request is translated into the API Gateway HTTP API event main.handler expects and
+handled on its own thread. Clients, caches and the background pool are shared by all
+requests. SIGTERM and SIGINT stop accepting connections, let requests in flight finish
+and then exit. Nothing verifies tokens before the server does, so it does not start
+without UserPoolIssuer and UserPoolClientId.
+
+    $ PORT=8080 TableName=... PolicyStoreId=... UserPoolIssuer=... UserPoolClientId=... python server.py
+"""
+
+
+port = int(os.environ.get("PORT", "8080"))
+idle_timeout = float(os.environ.get("IdleTimeout", "5"))
+
+HEALTH_PATH = "/health"
+
+
+def route_patterns():
+
+    """
+    (method, regex, route key) per route - literal routes first, so /posts/batch never matches /posts/{postId}
+    """
+
+    patterns = []
+
+    for resource, method in sorted(actions.ACTIONS, key = lambda route: "{" in route[0]):
+        regex = re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(resource))
+        patterns.append((method, re.compile(f"^{regex}$"), f"{method} {resource}"))
+
+    return patterns
+
+
+ROUTES = route_patterns()
+
+
+def match_route(method, path):
+    for route_method, regex, route_key in ROUTES:
+        match = regex.match(path)
+
+        if match and route_method == method:
+            return route_key, {name: unquote(value) for name, value in match.groupdict().items()} or None
+
+    return f"{method} {path}", None
+
+
+def to_event(method, target, headers, body) -> dict:
+    url = urlsplit(target)
+    route_key, path_parameters = match_route(method, url.path)
+
+    # API Gateway joins repeated query parameters with commas
+    query = {name: ",".join(values) for name, values in parse_qs(url.query, keep_blank_values = True).items()}
+
+    event = {
+        "version": "2.0",
+        "routeKey": route_key,
+        "rawPath": url.path,
+        "rawQueryString": url.query,
+        "headers": {name.lower(): value for name, value in headers.items()},
+        "queryStringParameters": query or None,
+        "pathParameters": path_parameters,
+        "requestContext": {"http": {"method": method, "path": url.path}},
+        "isBase64Encoded": False
+    }
+
+    if body:
+        try:
+            event["body"] = body.decode()
+        except UnicodeDecodeError:
+            event["body"] = base64.b64encode(body).decode()
+            event["isBase64Encoded"] = True
+
+    return event
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # Idle keep-alive connections are closed after this, so shutdown does not wait on them
+    timeout = idle_timeout
+
+
+    def handle_request(self):
+        if self.path == HEALTH_PATH:
+            return self.send(503 if self.server.draining else 200, {}, json.dumps({"draining": self.server.draining}).encode())
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        event = to_event(self.command, self.path, self.headers, body)
+        context = SimpleNamespace(aws_request_id = str(uuid.uuid4()))
+
+        try:
+            response = main.handler(event, context)
+        except Exception:
+            # main.handler has logged it already
+            return self.send(500, {"Content-Type": "application/json"}, b'{"message": "Internal Server Error"}')
+
+        payload = response.get("body") or ""
+        payload = base64.b64decode(payload) if response.get("isBase64Encoded") else payload.encode()
+
+        self.send(response["statusCode"], response.get("headers") or {}, payload)
+
+
+    def send(self, status_code, headers, payload):
+        self.send_response(status_code)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header("Content-Length", str(len(payload)))
+
+        if self.server.draining:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+
+    def log_message(self, format, *args):
+        # Requests are logged by main.handler
+        pass
+
+
+class Server(ThreadingHTTPServer):
+
+    # Wait for all request threads on server_close
+    daemon_threads = False
+    block_on_close = True
+    draining = False
+
+
+def serve():
+    if not tokens.verification_configured():
+        print(json.dumps({"message": "Not starting - set UserPoolIssuer and UserPoolClientId, the server verifies all tokens itself"}))
+        sys.exit(1)
+
+    server = Server(("", port), Handler)
+
+    def stop(signum, frame):
+        server.draining = True
+
+        # shutdown() blocks until serve_forever returns, it must not run on the serving thread
+        threading.Thread(target = server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(json.dumps({"message": "Listening", "port": port}))
+    server.serve_forever()
+
+    server.server_close()
+    main.shutdown()
+    print(json.dumps({"message": "Stopped"}))
+
+
+if __name__ == "__main__":
+    serve()
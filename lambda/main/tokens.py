@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+
+from collections import namedtuple
+
+import cache
+import log
+
+
+"""
+Token parsing
+
+Tokens are verified against the user pool JWKS, which is fetched once per container
+and only fetched again when a token is signed with a key id that is not known yet.
+A failed fetch is retried after JwksRetryInterval seconds, until then requests are
+answered as unavailable instead of as unauthenticated.
+Parsed tokens are cached per token string until they expire, so repeat requests
+skip base64 and JSON parsing and the signature check.
+"""
+
+
+Principal = namedtuple("Principal", ["userid", "author", "expires", "claims"])
+
+
+class TokenError(Exception):
+    pass
+
+
+class KeysUnavailable(Exception):
+
+    """
+    The signing keys could not be fetched - says nothing about the token itself
+    """
+
+
+user_pool_issuer = os.environ.get("UserPoolIssuer")
+user_pool_client_id = os.environ.get("UserPoolClientId")
+
+# Set where no API Gateway JWT authorizer checks the tokens first, e.g. by server.py - unverified tokens are never trusted
+require_verification = os.environ.get("RequireTokenVerification", "false").lower() == "true"
+
+# An unknown kid triggers at most one JWKS fetch per interval, so made-up key ids can't hammer Cognito
+jwks_refresh_interval = int(os.environ.get("JwksRefreshInterval", "60"))
+jwks_retry_interval = float(os.environ.get("JwksRetryInterval", "1"))
+
+token_cache = cache.LRUCache(int(os.environ.get("TokenCacheSize", "1024")))
+
+_jwks_lock = threading.Lock()
+_signing_keys = {}
+_jwks_fetched_at = 0.0
+_jwks_failed_at = 0.0
+_unverified_warning = False
+
+
+def verification_configured() -> bool:
+    return bool(user_pool_issuer and user_pool_client_id)
+
+
+def fetch_jwks() -> dict:
+    with urllib.request.urlopen(f"{user_pool_issuer}/.well-known/jwks.json", timeout = 5) as response:
+        return json.load(response)
+
+
+def signing_key(kid):
+    global _jwks_fetched_at, _jwks_failed_at
+
+    import jwt
+
+    key = _signing_keys.get(kid)
+    if key is not None:
+        return key
+
+    with _jwks_lock:
+        if kid not in _signing_keys and time.time() - _jwks_fetched_at >= jwks_refresh_interval:
+            # Only a successful fetch starts the refresh interval, a failed one is retried soon
+            if time.time() - _jwks_failed_at < jwks_retry_interval:
+                raise KeysUnavailable("Signing keys unavailable, the last fetch failed")
+
+            try:
+                jwks = jwt.PyJWKSet.from_dict(fetch_jwks())
+            except (OSError, ValueError, jwt.PyJWKSetError) as e:
+                _jwks_failed_at = time.time()
+                raise KeysUnavailable(f"Could not fetch the signing keys: {e}")
+
+            _jwks_fetched_at = time.time()
+            _signing_keys.update({jwk.key_id: jwk.key for jwk in jwks.keys})
+            log.info("Fetched user pool signing keys", keyIds = list(_signing_keys))
+
+    key = _signing_keys.get(kid)
+    if key is None:
+        raise TokenError(f"Unknown signing key {kid}")
+
+    return key
+
+
+def verified_claims(token: str, token_use: str) -> dict:
+    import jwt
+
+    try:
+        header = jwt.get_unverified_header(token)
+        claims = jwt.decode(
+            token,
+            signing_key(header.get("kid")),
+            algorithms = ["RS256"],
+            issuer = user_pool_issuer,
+            audience = user_pool_client_id if token_use == "id" else None,
+            options = {"require": ["exp", "iss", "sub", "token_use"], "verify_aud": token_use == "id"}
+        )
+    except jwt.InvalidTokenError as e:
+        raise TokenError(str(e))
+
+    if claims.get("token_use") != token_use:
+        raise TokenError(f"Expected an {token_use} token")
+
+    # Access tokens carry the app client in client_id instead of aud
+    if token_use == "access" and claims.get("client_id") != user_pool_client_id:
+        raise TokenError("Token was issued to another app client")
+
+    return claims
+
+
+def unverified_claims(token: str) -> dict:
+    import jwt
+
+    try:
+        return jwt.decode(token, options = {"verify_signature": False})
+    except jwt.InvalidTokenError as e:
+        raise TokenError(str(e))
+
+
+def parse(token: str, token_use: str, verify: bool = True) -> Principal:
+
+    """
+    Parse a Cognito token into a Principal - verified tokens are cached until they expire,
+    raises TokenError if the token is malformed, expired or not signed by the user pool
+    and KeysUnavailable if the user pool's signing keys cannot be fetched
+    """
+
+    if not token:
+        raise TokenError("Token missing")
+
+    if verify and not verification_configured():
+        if require_verification:
+            raise KeysUnavailable("Token verification is required, but UserPoolIssuer or UserPoolClientId is not set")
+
+        warn_unverified()
+        verify = False
+
+    cache_key = (token_use, verify, hashlib.sha256(token.encode()).digest())
+
+    principal = token_cache.get(cache_key)
+    if principal:
+        return principal
+
+    if verify:
+        claims = verified_claims(token, token_use)
+    else:
+        claims = unverified_claims(token)
+
+    if len(str(claims.get("iss")).split("/")) < 4 or not claims.get("sub"):
+        raise TokenError("Token is missing iss or sub")
+
+    username = claims.get("username") or claims.get("cognito:username")
+
+    principal = Principal(
+        userid = f"{claims['iss'].split('/')[3]}|{claims['sub']}",
+        author = f"{username}|{claims['sub'][:8]}",
+        expires = claims.get("exp"),
+        claims = claims
+    )
+
+    if principal.expires:
+        token_cache.put(cache_key, principal, principal.expires)
+
+    return principal
+
+
+def access_principal(token: str) -> Principal:
+    return parse(token, "access")
+
+
+def identity_claims(token: str, verify: bool = True) -> dict:
+    return parse(token, "id", verify).claims
+
+
+def warn_unverified():
+    global _unverified_warning
+
+    # Without a user pool to verify against we rely on the API Gateway JWT authorizer
+    if not _unverified_warning:
+        _unverified_warning = True
+        log.warning("UserPoolIssuer or UserPoolClientId not set, tokens are not verified")
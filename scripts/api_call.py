@@ -8,6 +8,12 @@ import conf_local as conf
 
 def main():
 
+    # Many virtual users instead of a single call
+    if len(sys.argv) >= 2 and sys.argv[1] == "--load":
+        import load
+        load.run(sys.argv[2:])
+        return
+
     # Collect request details
     details = get_args(sys.argv)
     username = details.get("username")
@@ -15,9 +21,8 @@ def main():
     resource = details.get("resource", "/")
     text = details.get("text")
 
-    # Check token file and if tokens are valid
-    token_file = f"{username}-tokens.json"
-    auth_status = auth.check_auth_status(token_file)
+    # Check token cache and if tokens are valid
+    auth_status = auth.check_auth_status(username)
 
     print(f"Checking login status of {username}")
     if auth_status == False:
@@ -25,15 +30,12 @@ def main():
         sys.exit(1)
 
     # Get access and identity token
-    with open(token_file, "r") as f:
-        tokens = json.load(f)
-        access_token = tokens.get("AccessToken")
-        identity_token = tokens.get("IdToken")
+    tokens = auth.read_tokens(username)
 
     # Define request headers
     headers = {}
-    headers["Authorization"] = f"Bearer {access_token}"
-    headers["IdToken"] = identity_token
+    headers["Authorization"] = f"Bearer {tokens.get('AccessToken')}"
+    headers["IdToken"] = tokens.get("IdToken")
     headers["Content-Type"] = "application/json"
     headers["Accept"] = "application/json"
 
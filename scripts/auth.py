@@ -1,42 +1,78 @@
 import boto3
 import json
-import pathlib
+import os
+import random
 import jwt
 import sys
+import threading
 import time
 
 import conf_local
 
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl - there only the threads of one process take turns
+    fcntl = None
+
+
+"""
+Tokens of all users are kept in one cache file, tokens.json, next to a tokens.json.lock
+that several scripts updating it at the same time take turns on. The TokenPool keeps them in
+memory and refreshes them with REFRESH_TOKEN_AUTH on a background thread before they
+expire, so long running scripts never stall on a login.
+"""
+
+
+CACHE_FILE = "tokens.json"
+
+_cache_lock = threading.Lock()
+
+
 def main():
     """ USAGE
-    (.venv) $ python auth.py <username>
+    (.venv) $ python auth.py <username> [<username> ...]
+    (.venv) $ python auth.py --keep-fresh <username> [<username> ...]
+
+    --keep-fresh keeps running and refreshes the tokens ahead of expiry, so other
+    scripts reading tokens.json always find valid tokens
     """
 
-    user_name = sys.argv[1]
+    keep_fresh = "--keep-fresh" in sys.argv[1:]
+    user_names = [arg for arg in sys.argv[1:] if arg != "--keep-fresh"]
 
-    if not user_exists(user_name):
-        print(f"User {user_name} does not exist here.")
-        sys.exit(1)
+    for user_name in user_names:
+        if not user_exists(user_name):
+            print(f"User {user_name} does not exist here.")
+            sys.exit(1)
 
-    filename = f"{user_name}-tokens.json"
+    if keep_fresh:
+        pool = TokenPool(user_names).start()
+        print(f"Keeping tokens of {', '.join(user_names)} fresh in {CACHE_FILE}, stop with Ctrl+C")
 
-    print("Checking auth status")
-    auth_status = check_auth_status(filename)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pool.stop()
 
-    if auth_status == False:
-        print(f"{user_name} is not authenticated. Authenticating now...")
-        auth_status = authenticate_user(user_name)
-    
-    if auth_status == True:
-        print(f"{user_name} is authenticated and token is valid for at least two minutes. Stored tokens in\n{filename}")
-    else:
-        print(f"The lights are on but noone is home.")
+        return
 
+    for user_name in user_names:
+        print("Checking auth status")
+        auth_status = check_auth_status(user_name)
 
-def authenticate_user(user_name) -> bool:
+        if auth_status == False:
+            print(f"{user_name} is not authenticated. Authenticating now...")
+            auth_status = authenticate_user(user_name)
 
-    cognito = boto3.client("cognito-idp")
+        if auth_status == True:
+            print(f"{user_name} is authenticated and token is valid for at least two minutes. Stored tokens in\n{CACHE_FILE}")
+        else:
+            print(f"The lights are on but noone is home.")
 
+
+def initiate_auth(cognito, user_name) -> dict:
     response = cognito.initiate_auth(
         AuthFlow = "USER_PASSWORD_AUTH",
         AuthParameters = {
@@ -46,40 +82,97 @@ def authenticate_user(user_name) -> bool:
         ClientId = conf_local.cognito_client_id
     )
 
-    result = response.get("AuthenticationResult")
+    return response.get("AuthenticationResult") or {}
+
+
+def refresh_auth(cognito, refresh_token) -> dict:
+    response = cognito.initiate_auth(
+        AuthFlow = "REFRESH_TOKEN_AUTH",
+        AuthParameters = {
+            "REFRESH_TOKEN": refresh_token
+        },
+        ClientId = conf_local.cognito_client_id
+    )
+
+    result = response.get("AuthenticationResult") or {}
+
+    # Cognito does not rotate the refresh token here, keep using the one we have
+    if result:
+        result.setdefault("RefreshToken", refresh_token)
+
+    return result
+
+
+def authenticate_user(user_name) -> bool:
+
+    cognito = boto3.client("cognito-idp")
+
+    result = initiate_auth(cognito, user_name)
 
     if result.get("AccessToken") and result.get("IdToken"):
-        filename = f"{user_name}-tokens.json"
-        with open(filename, mode="w") as f:
-            f.write(json.dumps(result))
+        update_cache({user_name: result})
 
         return True
 
     return False
 
 
-def check_auth_status(filename) -> bool:
+def read_cache(filename = CACHE_FILE) -> dict:
     try:
         with open(filename, mode="r") as f:
-            tokens = json.load(f)
+            return json.load(f)
 
     except FileNotFoundError:
-        return False
+        return {}
+
+
+def write_cache(cache, filename = CACHE_FILE):
+    # Readers never see a half written file, os.replace swaps it in atomically
+    temporary = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
 
+    with open(temporary, mode="w") as f:
+        f.write(json.dumps(cache))
+
+    os.replace(temporary, filename)
+
+
+def update_cache(tokens, filename = CACHE_FILE):
+    # Other processes merge their users into the same file - one read-merge-write at a time
+    with _cache_lock, open(f"{filename}.lock", mode="a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            cache = read_cache(filename)
+            cache.update(tokens)
+            write_cache(cache, filename)
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_tokens(user_name) -> dict:
+    return read_cache().get(user_name) or {}
+
+
+def expires_at(tokens) -> int:
     access_token = tokens.get("AccessToken")
+    if not access_token:
+        return 0
 
-    if access_token:
-        decoded_data = jwt.decode(jwt=access_token, options={"verify_signature": False})
-        time_now = int(time.time())
-        exp_time = decoded_data.get("exp")
+    decoded_data = jwt.decode(jwt=access_token, options={"verify_signature": False})
 
-        # Checking, if token is valid for at least two minutes
-        if exp_time - time_now < 120:
-            return False
+    return decoded_data.get("exp", 0)
 
-        return True
 
-    return False
+def check_auth_status(user_name) -> bool:
+    tokens = read_tokens(user_name)
+
+    # Checking, if token is valid for at least two minutes
+    if expires_at(tokens) - int(time.time()) < 120:
+        return False
+
+    return True
 
 
 def user_exists(user_name) -> bool:
@@ -89,5 +182,109 @@ def user_exists(user_name) -> bool:
     return False
 
 
+class TokenPool:
+
+    """
+    Tokens of many users in memory, refreshed on a background thread
+
+    Every user is refreshed refresh_margin seconds before the access token expires,
+    minus a random jitter, so users signed in at the same time do not all refresh at
+    once. Falls back to USER_PASSWORD_AUTH if the refresh token was revoked or expired.
+    """
+
+    def __init__(self, user_names, filename = CACHE_FILE, refresh_margin = 300, jitter = 120):
+        self.user_names = list(user_names)
+        self.filename = filename
+        self.refresh_margin = refresh_margin
+        self.jitter = jitter
+        self.errors = 0
+
+        self._cognito = boto3.client("cognito-idp")
+        self._tokens = {}
+        self._due = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        cached = read_cache(self.filename)
+
+        for user_name in self.user_names:
+            tokens = cached.get(user_name) or {}
+
+            if expires_at(tokens) - time.time() < self.refresh_margin:
+                tokens = self._renew(user_name, tokens)
+
+            self._set(user_name, tokens)
+
+        self._persist()
+
+        self._thread = threading.Thread(target = self._run, name = "token-refresh", daemon = True)
+        self._thread.start()
+
+        return self
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+    def get(self, user_name) -> dict:
+        # Plain dictionary lookup, callers can do this on every request
+        return self._tokens[user_name]
+
+
+    def _set(self, user_name, tokens):
+        if not tokens.get("AccessToken"):
+            raise RuntimeError(f"Could not authenticate {user_name}")
+
+        with self._lock:
+            self._tokens[user_name] = tokens
+            self._due[user_name] = expires_at(tokens) - self.refresh_margin - random.uniform(0, self.jitter)
+
+
+    def _renew(self, user_name, tokens) -> dict:
+        if tokens.get("RefreshToken"):
+            try:
+                return refresh_auth(self._cognito, tokens["RefreshToken"])
+            except self._cognito.exceptions.NotAuthorizedException:
+                pass
+
+        return initiate_auth(self._cognito, user_name)
+
+
+    def _persist(self):
+        with self._lock:
+            tokens = dict(self._tokens)
+
+        update_cache(tokens, self.filename)
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                if not self._due:
+                    # Nobody to refresh
+                    return
+
+                user_name, due = min(self._due.items(), key = lambda item: item[1])
+
+            if self._stop.wait(max(0.0, due - time.time())):
+                return
+
+            try:
+                self._set(user_name, self._renew(user_name, self._tokens[user_name]))
+                self._persist()
+            except Exception as error:
+                # Try again shortly, the current tokens may still be valid for a while
+                self.errors += 1
+                print(f"Refreshing tokens of {user_name} failed: {error}")
+                with self._lock:
+                    self._due[user_name] = time.time() + min(30, self.jitter)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,305 @@
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import jwt
+import requests
+
+import auth
+import conf_local as conf
+
+
+"""
+Load generation for the API
+
+Every virtual user is a thread with its own keep-alive session, signed in as one of
+the users in conf.users. The number of active virtual users follows a schedule of
+stages, e.g. "10:60,50:120" runs 10 users for a minute and then ramps up to 50 for
+two minutes. Latencies and status codes are reported per stage and route, so the
+stage where API Gateway, Lambda, Verified Permissions or DynamoDB start throttling
+(429) or failing (5xx) stands out.
+"""
+
+
+DEFAULT_MIX = "GET /:60,GET /posts:20,POST /posts:15,DELETE /posts/{postId}:5"
+
+HISTOGRAM_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class Stats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self.requests = 0
+
+
+    def record(self, stage, route, status, duration_ms):
+        with self._lock:
+            entry = self._routes.setdefault((stage, route), {"durations": [], "statuses": {}})
+            entry["durations"].append(duration_ms)
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            self.requests += 1
+
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {"durations": list(value["durations"]), "statuses": dict(value["statuses"])} for key, value in self._routes.items()}
+
+
+class VirtualUser:
+
+    def __init__(self, username, pool, authors):
+        self.username = username
+        self.pool = pool
+        self.authors = authors
+        self.posts = []
+        self.session = requests.Session()
+
+
+    def request(self, route):
+        method, resource = route.split(" ")
+        body = None
+
+        if route == "GET /posts":
+            resource = f"/posts?author={random.choice(self.authors)}"
+
+        elif route == "POST /posts":
+            body = {"text": f"Load test post {uuid.uuid4()}"}
+
+        elif route == "POST /posts/batch":
+            body = {"posts": [{"text": f"Load test post {uuid.uuid4()}"} for _ in range(10)]}
+
+        elif route == "DELETE /posts/{postId}":
+            if not self.posts:
+                return self.request("POST /posts")
+            resource = f"/posts/{self.posts.pop()}"
+
+        elif route == "DELETE /posts":
+            if not self.posts:
+                return self.request("POST /posts/batch")
+            body = {"postIds": self.posts[-25:]}
+            del self.posts[-25:]
+
+        started = time.perf_counter()
+        try:
+            # Tokens come from the pool on every request, they are refreshed in the background
+            headers = request_headers(self.pool.get(self.username))
+            response = self.session.request(method, conf.api + resource, headers = headers, json = body, timeout = 30)
+            status = response.status_code
+        except requests.RequestException as error:
+            response = None
+            status = type(error).__name__
+        duration_ms = (time.perf_counter() - started) * 1000
+
+        if response is not None and status == 200 and method == "POST":
+            self.remember(response)
+
+        return route, status, duration_ms
+
+
+    def remember(self, response):
+        # Created posts are deleted again later by the DELETE routes of the mix
+        try:
+            result = response.json()
+        except ValueError:
+            return
+
+        if "postId" in result:
+            self.posts.append(result["postId"])
+
+        for entry in result.get("results") or []:
+            if entry.get("status") == "created":
+                self.posts.append(entry["post"]["postId"])
+
+
+def run(args):
+
+    """ USAGE
+    (.venv) $ python api_call.py --load [--users alice,bob] [--stages 10:60,50:120] [--ramp-up 30] [--mix "GET /:80,POST /posts:20"]
+    """
+
+    options = parse_args(args)
+    stages = parse_stages(options.stages)
+    mix = parse_mix(options.mix)
+    usernames = options.users.split(",") if options.users else list(conf.users)
+
+    for username in usernames:
+        if not auth.user_exists(username):
+            raise SystemExit(f"User {username} does not exist here.")
+
+    pool = auth.TokenPool(usernames).start()
+    authors = [author_tag(pool.get(username)) for username in usernames]
+    max_users = max(count for count, _ in stages)
+
+    virtual_users = [
+        VirtualUser(username, pool, authors)
+        for username in (usernames[i % len(usernames)] for i in range(max_users))
+    ]
+
+    stats = Stats()
+    stop = threading.Event()
+    started = time.monotonic()
+
+    def schedule():
+        return active_users(stages, options.ramp_up, time.monotonic() - started)
+
+    threads = [
+        threading.Thread(target = drive, args = (index, virtual_user, mix, schedule, stats, stop, options.think_time), daemon = True)
+        for index, virtual_user in enumerate(virtual_users)
+    ]
+
+    print(f"Running {len(stages)} stage(s) with up to {max_users} virtual users as {', '.join(usernames)}")
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            stage, count = schedule()
+            if stage is None:
+                break
+            print(f"  stage {stage + 1}: {count} active users, {stats.requests} requests so far", end = "\r")
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nStopping")
+
+    stop.set()
+    for thread in threads:
+        thread.join(timeout = 35)
+    pool.stop()
+
+    print_report(stats.snapshot(), stages)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog = "api_call.py --load", description = "Generate load against the API")
+    parser.add_argument("--users", help = "comma separated users from conf.users, default all of them")
+    parser.add_argument("--stages", default = "10:60", help = "virtual users and seconds per stage, e.g. 10:60,50:120")
+    parser.add_argument("--ramp-up", type = float, default = 10.0, help = "seconds to go from one stage's users to the next")
+    parser.add_argument("--mix", default = DEFAULT_MIX, help = f"weighted routes, default \"{DEFAULT_MIX}\"")
+    parser.add_argument("--think-time", type = float, default = 0.0, help = "seconds each virtual user waits between requests")
+
+    return parser.parse_args(args)
+
+
+def parse_stages(value):
+    stages = []
+
+    for stage in value.split(","):
+        count, _, seconds = stage.partition(":")
+        stages.append((int(count), float(seconds)))
+
+    return stages
+
+
+def parse_mix(value):
+    routes = []
+    weights = []
+
+    for entry in value.split(","):
+        route, _, weight = entry.rpartition(":")
+        routes.append(route.strip())
+        weights.append(float(weight))
+
+    return routes, weights
+
+
+def active_users(stages, ramp_up, elapsed):
+
+    """
+    Returns (stage index, active virtual users) at the given time, the stage index is None once the schedule is over
+    """
+
+    previous = 0
+    stage_start = 0.0
+
+    for index, (count, seconds) in enumerate(stages):
+        if elapsed < stage_start + seconds:
+            ramp = min(1.0, (elapsed - stage_start) / ramp_up) if ramp_up > 0 else 1.0
+            return index, int(round(previous + (count - previous) * ramp))
+
+        previous = count
+        stage_start += seconds
+
+    return None, 0
+
+
+def drive(index, virtual_user, mix, schedule, stats, stop, think_time):
+    routes, weights = mix
+
+    while not stop.is_set():
+        stage, count = schedule()
+        if stage is None:
+            return
+
+        if index >= count:
+            time.sleep(0.1)
+            continue
+
+        route, status, duration_ms = virtual_user.request(random.choices(routes, weights)[0])
+        stats.record(stage, route, status, duration_ms)
+
+        if think_time:
+            time.sleep(think_time)
+
+
+def request_headers(tokens) -> dict:
+    return {
+        "Authorization": f"Bearer {tokens.get('AccessToken')}",
+        "IdToken": tokens.get("IdToken"),
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+
+
+def author_tag(tokens) -> str:
+    # Same format the function uses for the author attribute of a post
+    claims = jwt.decode(jwt = tokens.get("AccessToken"), options = {"verify_signature": False})
+
+    return f"{claims['username']}|{claims['sub'][:8]}"
+
+
+def percentile(values, rank):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(rank / 100 * len(ordered) + 0.5)) - 1))
+
+    return ordered[index]
+
+
+def histogram(durations):
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+
+    for duration in durations:
+        counts[next((i for i, bound in enumerate(HISTOGRAM_BUCKETS) if duration < bound), len(HISTOGRAM_BUCKETS))] += 1
+
+    labels = [f"< {bound} ms" for bound in HISTOGRAM_BUCKETS] + [f">= {HISTOGRAM_BUCKETS[-1]} ms"]
+    widest = max(counts) or 1
+
+    return [f"      {label:>12} {count:>7} {'#' * int(40 * count / widest)}" for label, count in zip(labels, counts) if count]
+
+
+def print_report(snapshot, stages):
+    print()
+
+    for stage, (count, seconds) in enumerate(stages):
+        entries = sorted((route, value) for (index, route), value in snapshot.items() if index == stage)
+        if not entries:
+            continue
+
+        print(f"\nStage {stage + 1}: {count} virtual users for {seconds:g} s")
+
+        for route, value in entries:
+            durations = value["durations"]
+            statuses = value["statuses"]
+            errors = sum(number for status, number in statuses.items() if status != 200)
+            throttled = statuses.get(429, 0)
+
+            print(
+                f"  {route:<24} {len(durations):>7} requests {len(durations) / seconds:>8.1f}/s"
+                f"  p50 {percentile(durations, 50):>7.1f} ms  p95 {percentile(durations, 95):>7.1f} ms  p99 {percentile(durations, 99):>7.1f} ms"
+                f"  errors {100 * errors / len(durations):5.1f}%  throttled {100 * throttled / len(durations):5.1f}%"
+            )
+            print(f"      statuses {statuses}")
+            print("\n".join(histogram(durations)))
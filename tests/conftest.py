@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The function's modules import each other by name, as they do in the Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "main"))
+
+# Read on import - the tests never reach AWS
+os.environ.setdefault("TableName", "TestPostTable")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("LogLevel", "ERROR")
+os.environ.setdefault("Metrics", "false")
@@ -0,0 +1,72 @@
+import time
+
+from types import SimpleNamespace
+
+import cache
+
+
+def test_get_returns_what_was_put():
+    entries = cache.LRUCache(4)
+    entries.put("a", 1)
+
+    assert entries.get("a") == 1
+    assert entries.get("b") is None
+    assert entries.get("b", "default") == "default"
+
+
+def test_expired_entry_is_a_miss_and_dropped():
+    entries = cache.LRUCache(4)
+    entries.put("a", 1, expires_at = time.time() - 1)
+    entries.put("b", 2, expires_at = time.time() + 60)
+
+    assert entries.get("a") is None
+    assert entries.get("b") == 2
+    assert entries.stats() == {"hits": 1, "misses": 1, "size": 1, "hitRate": 0.5}
+
+
+def test_entry_expires_at_its_time(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, "time", SimpleNamespace(time = lambda: now[0]))
+
+    entries = cache.LRUCache(4)
+    entries.put("a", 1, expires_at = 1010.0)
+
+    now[0] = 1009.999
+    assert entries.get("a") == 1
+
+    now[0] = 1010.0
+    assert entries.get("a") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    entries = cache.LRUCache(2)
+    entries.put("a", 1)
+    entries.put("b", 2)
+
+    # Reading a makes b the least recently used
+    entries.get("a")
+    entries.put("c", 3)
+
+    assert entries.get("a") == 1
+    assert entries.get("b") is None
+    assert entries.get("c") == 3
+
+
+def test_zero_size_caches_nothing():
+    entries = cache.LRUCache(0)
+    entries.put("a", 1)
+
+    assert entries.get("a") is None
+
+
+def test_invalidate_and_clear():
+    entries = cache.LRUCache(4)
+    entries.put("a", 1)
+    entries.put("b", 2)
+
+    entries.invalidate("a")
+    assert entries.get("a") is None
+
+    entries.clear()
+    assert entries.get("b") is None
+    assert entries.stats()["size"] == 0
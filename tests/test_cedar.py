@@ -0,0 +1,85 @@
+import jwt
+import pytest
+
+import cedar
+import permissions
+import plans
+
+
+ISSUER = "https://cognito-idp.us-east-1.amazonaws.com/test_pool"
+
+ALICE = {"iss": ISSUER, "sub": "alice-sub", "token_use": "id", "cognito:username": "alice"}
+BOB = {"iss": ISSUER, "sub": "bob-sub", "token_use": "id", "cognito:username": "bob"}
+ADMIN = {"iss": ISSUER, "sub": "admin-sub", "token_use": "id", "cognito:username": "admin", "custom:appRole": "admin"}
+
+ALICES_POST = {"postId": "post-1", "userId": "test_pool|alice-sub", "author": "alice|alice-su"}
+
+# What Verified Permissions decides with the policies in cdk/policy_store
+CASES = [
+    (ALICE, "GetAllPosts", None, "ALLOW"),
+    (ALICE, "GetUserPosts", None, "ALLOW"),
+    (ALICE, "CreatePost", None, "ALLOW"),
+    (ALICE, "DeletePost", ALICES_POST, "ALLOW"),
+    (BOB, "DeletePost", ALICES_POST, "DENY"),
+    (BOB, "DeletePost", {"postId": "post-1"}, "DENY"),
+    (ADMIN, "GetAllPosts", None, "ALLOW"),
+    (ADMIN, "DeletePost", ALICES_POST, "ALLOW"),
+    # admin_restriction forbids what all_users permits
+    (ADMIN, "CreatePost", None, "DENY"),
+    (dict(BOB, **{"custom:appRole": "editor"}), "DeletePost", ALICES_POST, "DENY")
+]
+
+
+@pytest.fixture
+def policy_set(monkeypatch):
+    policy_set = cedar.PolicySet.from_directory(plans.policy_directory)
+    monkeypatch.setattr(permissions, "policy_set", policy_set)
+    monkeypatch.setattr(permissions, "shadow_stats", {"compared": 0, "mismatches": 0})
+
+    return policy_set
+
+
+def identity_token(claims):
+    # Shadow mode reads the claims without verifying them, the signature does not matter here
+    return jwt.encode(dict(claims, exp = 4102444800), "a test secret long enough for HS256 keys", algorithm = "HS256")
+
+
+@pytest.mark.parametrize("claims, action, resource, expected", CASES)
+def test_local_decision_matches_shipped_policies(policy_set, claims, action, resource, expected):
+    assert permissions.evaluate_locally(claims, action, resource) == expected
+
+
+@pytest.mark.parametrize("claims, action, resource, expected", CASES)
+def test_shadow_compare_agrees_with_avp(policy_set, claims, action, resource, expected):
+    permissions.compare_decision(identity_token(claims), action, resource, expected)
+
+    assert permissions.shadow_stats == {"compared": 1, "mismatches": 0}
+
+
+def test_shadow_compare_counts_a_mismatch(policy_set):
+    permissions.compare_decision(identity_token(BOB), "DeletePost", ALICES_POST, "ALLOW")
+
+    assert permissions.shadow_stats == {"compared": 1, "mismatches": 1}
+
+
+def test_forbid_wins_over_permit(policy_set):
+    decision = policy_set.is_authorized(
+        cedar.Entity("SimplePosts::User", "test_pool|admin-sub"),
+        cedar.Entity("SimplePosts::Action", "CreatePost"),
+        cedar.Entity("SimplePosts::Application", "app"),
+        {cedar.Entity("SimplePosts::User", "test_pool|admin-sub"): {"attrs": {"custom": {"appRole": "admin"}}}}
+    )
+
+    assert decision.decision == "DENY"
+    assert [policy.split(".")[0] for policy in decision.determining_policies] == ["admin_restriction"]
+
+
+def test_unknown_action_is_denied(policy_set):
+    decision = policy_set.is_authorized(
+        cedar.Entity("SimplePosts::User", "test_pool|alice-sub"),
+        cedar.Entity("SimplePosts::Action", "EditPost"),
+        cedar.Entity("SimplePosts::Application", "app")
+    )
+
+    assert decision.decision == "DENY"
+
@@ -0,0 +1,177 @@
+import base64
+import json
+import uuid
+
+from types import SimpleNamespace
+
+import pytest
+
+import database
+
+
+AUTHOR_KEY = {"userId": "pool|alice", "postId": "post-1", "author": "alice|12345678"}
+
+
+def encode(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def test_cursor_round_trip():
+    cursor = database.encode_cursor(AUTHOR_KEY)
+
+    assert database.decode_cursor(cursor) == AUTHOR_KEY
+    assert database.decode_cursor(cursor, "alice|12345678") == AUTHOR_KEY
+
+
+def test_no_key_no_cursor():
+    assert database.encode_cursor(None) is None
+    assert database.encode_cursor({}) is None
+    assert database.decode_cursor(None) is None
+    assert database.decode_cursor("") is None
+
+
+def test_cursor_is_url_safe():
+    cursor = database.encode_cursor({"postId": "\xff\xfe?>" * 10})
+
+    assert set(cursor) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    base64.urlsafe_b64encode(b"not json").decode(),
+    encode(["postId", "post-1"]),
+    encode({"postId": 1}),
+    encode({"postId": {"S": "post-1"}})
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match = "malformed cursor"):
+        database.decode_cursor(cursor)
+
+
+def test_cursor_of_another_author_is_rejected():
+    with pytest.raises(ValueError, match = "another author"):
+        database.decode_cursor(database.encode_cursor(AUTHOR_KEY), "bob|87654321")
+
+
+@pytest.mark.parametrize("limit, expected", [(None, 50), ("1", 1), ("50", 50), ("100", 100), ("5000", 100)])
+def test_page_limit(limit, expected):
+    assert database.page_limit(limit) == expected
+
+
+@pytest.mark.parametrize("limit", ["0", "-1", "ten", "1.5"])
+def test_invalid_page_limit_is_rejected(limit):
+    with pytest.raises(ValueError):
+        database.page_limit(limit)
+
+
+def test_timeline_cursor_round_trip():
+    position = {"bucket": "1700006400", "keys": [None] * database.timeline_shards, "done": []}
+
+    assert database.decode_timeline_cursor(database.encode_cursor(position)) == position
+
+
+def test_timeline_cursor_needs_a_key_per_shard():
+    position = {"bucket": "1700006400", "keys": [None] * (database.timeline_shards + 1), "done": []}
+
+    with pytest.raises(ValueError, match = "outdated"):
+        database.decode_timeline_cursor(database.encode_cursor(position))
+
+
+@pytest.mark.parametrize("position", [
+    {"bucket": 1700006400, "keys": [None], "done": []},
+    {"bucket": "yesterday", "keys": [None], "done": []},
+    {"bucket": "1700006400", "keys": [None], "done": [1]},
+    {"bucket": "1700006400", "keys": ["post-1"], "done": []}
+])
+def test_malformed_timeline_cursor_is_rejected(position):
+    with pytest.raises(ValueError, match = "malformed cursor"):
+        database.decode_timeline_cursor(encode(position))
+
+
+@pytest.fixture
+def frozen_clock(monkeypatch):
+    # Every id in the same millisecond, as in a burst of writes
+    monkeypatch.setattr(database, "time", SimpleNamespace(time_ns = lambda: 1_700_000_000_123_000_000, time = lambda: 1_700_000_000.123))
+    monkeypatch.setattr(database, "_last_post_id", [0, 0])
+
+
+def test_post_ids_are_uuid7_of_their_time():
+    postid = database.new_post_id(1_700_000_000_123)
+    value = uuid.UUID(postid)
+
+    assert value.version == 7
+    assert value.variant == uuid.RFC_4122
+    assert database.post_id_time(postid) == 1_700_000_000_123
+
+
+def test_post_ids_sort_in_creation_order():
+    postids = [database.new_post_id() for _ in range(10000)]
+
+    assert postids == sorted(postids)
+    assert len(set(postids)) == len(postids)
+
+
+def test_post_ids_of_one_millisecond_sort_in_creation_order(frozen_clock):
+    postids = [database.new_post_id() for _ in range(100)]
+
+    assert postids == sorted(postids)
+    assert {database.post_id_time(postid) for postid in postids} == {1_700_000_000_123}
+
+
+def test_exhausted_sequence_borrows_the_next_millisecond(frozen_clock):
+    # The sequence starts below 0x800, so 4096 ids cannot fit into one millisecond
+    postids = [database.new_post_id() for _ in range(4096)]
+
+    assert postids == sorted(postids)
+    assert database.post_id_time(postids[-1]) == 1_700_000_000_124
+
+
+def test_new_post_time_is_the_time_of_its_id():
+    for _ in range(1000):
+        post = database.new_post("pool|alice", "text", "alice|12345678")
+
+        assert int(post["time"]) == database.post_id_time(post["postId"]) // 1000
+
+
+def test_post_id_bounds_enclose_the_ids_of_their_millisecond():
+    postid = database.new_post_id(1_700_000_000_123)
+
+    assert database.post_id_bound(1_700_000_000_123) <= postid <= database.post_id_bound(1_700_000_000_123, upper = True)
+    assert database.post_id_bound(1_700_000_000_122, upper = True) < postid < database.post_id_bound(1_700_000_000_124)
+
+
+def test_author_range_without_bounds_is_open():
+    assert database.author_range() == (None, None)
+
+
+def test_author_range_bounds_are_exclusive():
+    lowest, highest = database.author_range(before = 1_700_000_010, after = 1_700_000_000)
+
+    assert lowest == database.post_id_bound(1_700_000_001_000)
+    assert highest == database.post_id_bound(1_700_000_009_999, upper = True)
+
+    assert lowest <= database.new_post_id(1_700_000_001_000)
+    assert database.new_post_id(1_700_000_009_999) <= highest
+    assert database.new_post_id(1_700_000_000_999) < lowest
+    assert database.new_post_id(1_700_000_010_000) > highest
+
+
+@pytest.mark.parametrize("before, after", [(0, None), (10, 9), (10, 10), (10, 20)])
+def test_empty_author_range(before, after):
+    assert database.author_range(before = before, after = after) is None
+
+
+@pytest.mark.parametrize("before, after", [("-1", None), (None, "yesterday"), ("1.5", None)])
+def test_invalid_author_range_is_rejected(before, after):
+    with pytest.raises(ValueError, match = "epoch timestamp"):
+        database.author_range(before = before, after = after)
+
+
+def test_cursor_outside_of_the_range_is_rejected():
+    start_key = {"postId": database.new_post_id(1_700_000_020_000)}
+
+    with pytest.raises(ValueError, match = "outside"):
+        database.author_range(before = 1_700_000_010, start_key = start_key)
+
+    assert database.author_range(before = 1_700_000_030, start_key = start_key) is not None
@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+
+import pytest
+
+import resilience
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 100.0
+
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience, "time", SimpleNamespace(monotonic = clock.monotonic, perf_counter = clock.monotonic))
+
+    return clock
+
+
+def service_error(status_code, code = "InternalServerException"):
+    error = Exception(code)
+    error.response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}}
+
+    return error
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = resilience.CircuitBreaker("Test", failure_threshold = 3, cooldown = 10)
+
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.state == resilience.CLOSED and breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = resilience.CircuitBreaker("Test", failure_threshold = 3, cooldown = 10)
+
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+
+    assert breaker.state == resilience.CLOSED
+
+
+def test_one_probe_after_the_cooldown(clock):
+    breaker = resilience.CircuitBreaker("Test", failure_threshold = 1, cooldown = 10)
+    breaker.failure()
+
+    clock.now += 9.9
+    assert not breaker.allow()
+
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == resilience.HALF_OPEN
+
+    # Only the probe gets through until it is back
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_the_breaker(clock):
+    breaker = resilience.CircuitBreaker("Test", failure_threshold = 1, cooldown = 10)
+    breaker.failure()
+    clock.now += 10
+    breaker.allow()
+
+    breaker.success()
+
+    assert breaker.state == resilience.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_the_breaker_for_another_cooldown(clock):
+    breaker = resilience.CircuitBreaker("Test", failure_threshold = 5, cooldown = 10)
+    for _ in range(5):
+        breaker.failure()
+    clock.now += 10
+    breaker.allow()
+
+    # One failure is enough while half open
+    breaker.failure()
+
+    assert breaker.state == resilience.OPEN
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_call_is_rejected_while_open(clock):
+    call = resilience.ResilientCall("Test", failure_threshold = 1, hedge = False)
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise service_error(503, "ServiceUnavailableException")
+
+    with pytest.raises(Exception, match = "ServiceUnavailable"):
+        call.call(failing)
+
+    with pytest.raises(resilience.CircuitOpen):
+        call.call(failing)
+
+    assert len(calls) == 1
+
+
+def test_client_errors_do_not_open_the_breaker(clock):
+    call = resilience.ResilientCall("Test", failure_threshold = 1, hedge = False)
+
+    def invalid():
+        raise service_error(400, "ValidationException")
+
+    for _ in range(3):
+        with pytest.raises(Exception, match = "ValidationException"):
+            call.call(invalid)
+
+    assert call.breaker.state == resilience.CLOSED
+
+
+@pytest.mark.parametrize("error, unhealthy", [
+    (service_error(500), True),
+    (service_error(503, "ServiceUnavailableException"), True),
+    (service_error(429, "TooManyRequestsException"), True),
+    (service_error(400, "ThrottlingException"), True),
+    (service_error(400, "ValidationException"), False),
+    (service_error(403, "AccessDeniedException"), False),
+    (TimeoutError("read timeout"), True)
+])
+def test_unhealthy(error, unhealthy):
+    assert resilience.unhealthy(error) == unhealthy
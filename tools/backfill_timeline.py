@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "main"))
+
+
+def main():
+    """ USAGE
+    (.venv) $ python tools/backfill_timeline.py <table_name> [workers]
+
+    Sets the timeBucket attribute on every post that does not have the one it should,
+    so posts created before the timeline_index existed show up on GET /, and marks the
+    oldest bucket GET / walks back to. Run it with the same TimelineBucketSeconds and
+    TimelineShards the function uses, again after changing either. Safe to run more than once.
+    """
+
+    os.environ["TableName"] = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) >= 3 else None
+
+    import database
+    import scan
+
+    table = database.get_table()
+    updated = 0
+    skipped = 0
+    oldest = None
+
+    for batch in scan.scan_all_posts(workers = workers):
+        for post in batch:
+            bucket = database.time_bucket(post["time"], post["postId"])
+            start = database.bucket_start(post["time"])
+            oldest = start if oldest is None else min(oldest, start)
+
+            if post.get("timeBucket") == bucket:
+                skipped += 1
+                continue
+
+            try:
+                table.update_item(
+                    Key = {"userId": post["userId"], "postId": post["postId"]},
+                    UpdateExpression = "SET timeBucket = :bucket",
+                    ConditionExpression = "attribute_exists(postId)",
+                    ExpressionAttributeValues = {":bucket": bucket}
+                )
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                # Deleted while the backfill was running
+                skipped += 1
+                continue
+
+            updated += 1
+
+        print(f"Updated {updated} posts, {skipped} already had their time bucket")
+
+    if oldest is not None:
+        database.note_bucket(oldest)
+        print(f"Oldest time bucket is {oldest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import time
+import tracemalloc
+import uuid
+
+from types import SimpleNamespace
+
+import standins
+
+
+ISSUER = "https://cognito-idp.local.amazonaws.com/bench_pool"
+CLIENT_ID = "bench-client"
+TABLE_NAME = "BenchPostTable"
+
+
+def main():
+    """ USAGE
+    (.venv) $ python tools/bench_handler.py [--iterations 500] [--ddb-latency-ms 5] [--avp-latency-ms 20]
+
+    Drives main.handler with synthetic API Gateway v2 events for every route in
+    actions.ACTIONS, against local stand-ins for DynamoDB and Verified Permissions.
+    Prints p50/p95/p99 latency and allocated memory per request for each route.
+    Environment variables of the function apply, e.g. PolicyEvaluation=local or
+    DecisionCacheTtl=0 to benchmark without the decision cache.
+    """
+
+    options = parse_args()
+    configure_environment()
+
+    signing_key, jwks = signing_keys()
+
+    import cedar
+    import clients
+    import database
+    import tokens
+
+    policy_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cdk", "policy_store")
+    table = standins.LocalTable(options.ddb_latency_ms / 1000)
+    avp = standins.LocalVerifiedPermissions(cedar.PolicySet.from_directory(policy_dir), options.avp_latency_ms / 1000)
+
+    clients.override(table_name = TABLE_NAME, table = table)
+    clients.override(service_name = "dynamodb", service_client = standins.LocalClient(table))
+    clients.override(service_name = "verifiedpermissions", service_client = avp)
+    tokens.fetch_jwks = lambda: jwks
+
+    function = importlib.import_module("main")
+    actions = importlib.import_module("actions")
+
+    users = {
+        "alice": user_tokens(signing_key, "alice"),
+        "bob": user_tokens(signing_key, "bob"),
+        "admin": user_tokens(signing_key, "admin", app_role = "admin")
+    }
+    posts = seed_posts(users, options.posts)
+    table.seed(posts)
+
+    # Posts put in place directly need the marker the function writes before its own posts
+    database.note_bucket(min(database.bucket_start(post["time"]) for post in posts))
+
+    scenarios = build_scenarios(users, table)
+    results = []
+
+    for (resource, method), action in actions.ACTIONS.items():
+        if options.routes and action not in options.routes:
+            continue
+
+        scenario = scenarios.get(action)
+        if scenario is None:
+            print(f"No scenario for {action} ({method} {resource}), skipping")
+            continue
+
+        results.append(run_scenario(function, action, scenario, options, table, avp))
+
+    print_report(results, options)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Benchmark main.handler locally")
+    parser.add_argument("--iterations", type = int, default = 500, help = "timed requests per route")
+    parser.add_argument("--warmup", type = int, default = 50, help = "untimed requests per route before measuring")
+    parser.add_argument("--allocation-samples", type = int, default = 100, help = "requests per route traced with tracemalloc")
+    parser.add_argument("--posts", type = int, default = 500, help = "posts in the table before the run")
+    parser.add_argument("--ddb-latency-ms", type = float, default = 0.0, help = "latency injected into every DynamoDB call")
+    parser.add_argument("--avp-latency-ms", type = float, default = 0.0, help = "latency injected into every Verified Permissions call")
+    parser.add_argument("--routes", nargs = "*", help = "only run these actions, e.g. GetAllPosts DeletePost")
+    parser.add_argument("--json", action = "store_true", help = "print the results as json, e.g. to compare runs")
+
+    return parser.parse_args()
+
+
+def configure_environment():
+    # Must happen before the function modules are imported, they read their settings at import time
+    os.environ["TableName"] = TABLE_NAME
+    os.environ["UserPoolIssuer"] = ISSUER
+    os.environ["UserPoolClientId"] = CLIENT_ID
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("PolicyStoreId", "bench-policy-store")
+    os.environ.setdefault("LogLevel", "ERROR")
+    os.environ.setdefault("LogSampleRate", "0")
+    os.environ.setdefault("Metrics", "false")
+
+
+def signing_keys():
+    import jwt
+
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent = 65537, key_size = 2048)
+    public_jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    public_jwk.update({"kid": "bench", "alg": "RS256", "use": "sig"})
+
+    return private_key, {"keys": [public_jwk]}
+
+
+def user_tokens(signing_key, username, app_role = None):
+    import jwt
+
+    sub = str(uuid.uuid4())
+    expires = int(time.time()) + 24 * 3600
+    common = {"sub": sub, "iss": ISSUER, "exp": expires, "iat": int(time.time())}
+
+    access_claims = dict(common, token_use = "access", client_id = CLIENT_ID, username = username)
+    identity_claims = dict(common, token_use = "id", aud = CLIENT_ID)
+    identity_claims["cognito:username"] = username
+    if app_role:
+        identity_claims["custom:appRole"] = app_role
+
+    return {
+        "access": jwt.encode(access_claims, signing_key, algorithm = "RS256", headers = {"kid": "bench"}),
+        "id": jwt.encode(identity_claims, signing_key, algorithm = "RS256", headers = {"kid": "bench"}),
+        "userid": f"{ISSUER.split('/')[3]}|{sub}",
+        "author": f"{username}|{sub[:8]}"
+    }
+
+
+def new_post(user, age_seconds = 0):
+    import database
+
+    timestamp = str(int(time.time() - age_seconds))
+    postid = database.new_post_id(int(timestamp) * 1000)
+
+    return {
+        "userId": user["userid"],
+        "postId": postid,
+        "time": timestamp,
+        "timeBucket": database.time_bucket(timestamp, postid),
+        "text": "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 2,
+        "author": user["author"]
+    }
+
+
+def seed_posts(users, count):
+    authors = [users["alice"], users["bob"]]
+
+    return [new_post(random.choice(authors), random.randint(0, 30 * 24 * 3600)) for _ in range(count)]
+
+
+def event(user, route_key, parameters = None, path = None, body = None):
+    return {
+        "version": "2.0",
+        "routeKey": route_key,
+        "rawPath": route_key.split(" ")[1],
+        "headers": {
+            "authorization": f"Bearer {user['access']}",
+            "idtoken": user["id"],
+            "accept-encoding": "gzip, deflate",
+            "content-type": "application/json"
+        },
+        "queryStringParameters": parameters,
+        "pathParameters": path,
+        "body": json.dumps(body) if body is not None else None,
+        "isBase64Encoded": False
+    }
+
+
+def build_scenarios(users, table):
+
+    """
+    One event factory per action - factories may put data in place first, that part is not timed
+    """
+
+    alice = users["alice"]
+
+    def delete_post():
+        post = new_post(alice)
+        table.seed([post])
+        return event(alice, "DELETE /posts/{postId}", path = {"postId": post["postId"]})
+
+    def batch_delete_posts():
+        posts = [new_post(alice) for _ in range(25)]
+        table.seed(posts)
+        return event(alice, "DELETE /posts", body = {"postIds": [post["postId"] for post in posts]})
+
+    return {
+        "GetAllPosts": lambda: event(alice, "GET /", parameters = {"limit": "50"}),
+        "GetUserPosts": lambda: event(users["bob"], "GET /posts", parameters = {"author": alice["author"], "limit": "50"}),
+        "CreatePost": lambda: event(alice, "POST /posts", body = {"text": "Benchmark post"}),
+        "DeletePost": delete_post,
+        "BatchCreatePosts": lambda: event(alice, "POST /posts/batch", body = {"posts": [{"text": f"Benchmark post {i}"} for i in range(25)]}),
+        "BatchDeletePosts": batch_delete_posts
+    }
+
+
+def run_scenario(function, action, scenario, options, table, avp):
+    context = SimpleNamespace(aws_request_id = "bench")
+    statuses = {}
+
+    for _ in range(options.warmup):
+        function.handler(scenario(), context)
+
+    table_calls, avp_calls = table.calls, avp.calls
+    durations = []
+
+    for _ in range(options.iterations):
+        request = scenario()
+
+        started = time.perf_counter()
+        response = function.handler(request, context)
+        durations.append((time.perf_counter() - started) * 1000)
+
+        statuses[response["statusCode"]] = statuses.get(response["statusCode"], 0) + 1
+
+    calls = {
+        "dynamodb": (table.calls - table_calls) / max(options.iterations, 1),
+        "avp": (avp.calls - avp_calls) / max(options.iterations, 1)
+    }
+
+    # Traced separately, tracemalloc slows everything down and would distort the latencies
+    allocated = []
+    tracemalloc.start()
+
+    for _ in range(options.allocation_samples):
+        request = scenario()
+
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        function.handler(request, context)
+        _, peak = tracemalloc.get_traced_memory()
+        allocated.append((peak - before) / 1024)
+
+    tracemalloc.stop()
+
+    return {
+        "action": action,
+        "requests": len(durations),
+        "statuses": statuses,
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "p99": percentile(durations, 99),
+        "mean": sum(durations) / len(durations) if durations else 0.0,
+        "peakKiB": percentile(allocated, 50),
+        "callsPerRequest": calls
+    }
+
+
+def percentile(values, rank):
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(rank / 100 * len(ordered) + 0.5)) - 1))
+
+    return ordered[index]
+
+
+def print_report(results, options):
+    if options.json:
+        print(json.dumps(results, indent = 4))
+        return
+
+    print(f"\n{options.iterations} requests per route, {options.posts} seeded posts, "
+          f"DynamoDB latency {options.ddb_latency_ms} ms, AVP latency {options.avp_latency_ms} ms\n")
+    print(f"{'action':<18}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mean ms':>9}{'peak KiB':>10}{'ddb/req':>9}{'avp/req':>9}  statuses")
+
+    for result in results:
+        print(
+            f"{result['action']:<18}"
+            f"{result['p50']:>9.3f}{result['p95']:>9.3f}{result['p99']:>9.3f}{result['mean']:>9.3f}"
+            f"{result['peakKiB']:>10.1f}"
+            f"{result['callsPerRequest']['dynamodb']:>9.2f}{result['callsPerRequest']['avp']:>9.2f}"
+            f"  {result['statuses']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "main")
+
+
+def main():
+    """ USAGE
+    (.venv) $ python tools/import_report.py [module] [top] [eager]
+
+    Imports a module of lambda/main (default: main) in a fresh interpreter with
+    python -X importtime and prints the slowest imports. Pass "eager" to import
+    with ClientInit=eager, the way a provisioned concurrency container starts.
+    """
+
+    module = sys.argv[1] if len(sys.argv) >= 2 else "main"
+    top = int(sys.argv[2]) if len(sys.argv) >= 3 else 25
+    eager = len(sys.argv) >= 4 and sys.argv[3] == "eager"
+
+    imports = measure_imports(module, eager)
+    print_report(module, imports, top)
+
+
+def measure_imports(module, eager = False) -> list:
+    env = dict(os.environ)
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    env.setdefault("TableName", "ImportReportTable")
+    env["ClientInit"] = "eager" if eager else "lazy"
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd = LAMBDA_DIR,
+        env = env,
+        capture_output = True,
+        text = True
+    )
+
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    return parse_importtime(result.stderr)
+
+
+def parse_importtime(output) -> list:
+
+    """
+    Lines look like "import time:       412 |       1534 |   boto3.session" - self and
+    cumulative microseconds, the indentation of the name shows the nesting level
+    """
+
+    imports = []
+
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+
+        imports.append({
+            "name": name.strip(),
+            "self": int(self_us),
+            "cumulative": int(cumulative_us),
+            "depth": depth
+        })
+
+    return imports
+
+
+def print_report(module, imports, top):
+    total = sum(entry["self"] for entry in imports)
+    top_level = sorted(
+        (entry for entry in imports if entry["depth"] == 0),
+        key = lambda entry: entry["cumulative"],
+        reverse = True
+    )
+    slowest = sorted(imports, key = lambda entry: entry["self"], reverse = True)
+
+    print(f"Importing {module} loads {len(imports)} modules in {total / 1000:.1f} ms\n")
+
+    print("Top-level imports by cumulative time")
+    for entry in top_level[:top]:
+        print(f"{entry['cumulative'] / 1000:10.2f} ms  {entry['name']}")
+
+    print("\nModules by self time")
+    for entry in slowest[:top]:
+        print(f"{entry['self'] / 1000:10.2f} ms  {entry['name']}")
+
+
+if __name__ == "__main__":
+    main()
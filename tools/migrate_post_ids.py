@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "main"))
+
+
+def is_time_sortable(postid) -> bool:
+    try:
+        return uuid.UUID(postid).version == 7
+    except ValueError:
+        return False
+
+
+def main():
+    """ USAGE
+    (.venv) $ python tools/migrate_post_ids.py <table_name> [workers] [--dry-run]
+
+    Gives every post with a random (UUIDv4) postId a time-sortable UUIDv7 one made from
+    the time it was created, so it shows up in the right place of GET /posts?author=...
+    The postId is the sort key, so every post is written under its new id and deleted
+    under the old one in one transaction. Every change is appended to post_id_map.jsonl
+    as {"old": ..., "new": ...}, e.g. to redirect links to old ids. Safe to run more than
+    once, and while the function is serving requests.
+
+    Cached pages of GET /posts?author=... still list the old ids. With ReadCache=redis, run
+    the migration with the same ReadCache and ReadCacheUrl as the function, so it bumps the
+    version of every author it migrates in the shared cache - or flush the cache afterwards,
+    or wait ReadCacheTtl seconds for the pages to expire. A memory read cache lives in the
+    processes of the container server, the migration cannot reach it: restart the server.
+    """
+
+    arguments = [argument for argument in sys.argv[1:] if argument != "--dry-run"]
+    dry_run = "--dry-run" in sys.argv
+
+    os.environ["TableName"] = arguments[0]
+    workers = int(arguments[1]) if len(arguments) >= 2 else None
+
+    import database
+    import scan
+    import readcache
+
+    client = database.get_table().meta.client
+    migrated = 0
+    skipped = 0
+
+    with open("post_id_map.jsonl", "a") as mapping:
+        for batch in scan.scan_all_posts(workers = workers):
+            for post in batch:
+                if is_time_sortable(post["postId"]):
+                    skipped += 1
+                    continue
+
+                postid = database.new_post_id(int(post["time"]) * 1000)
+
+                if not dry_run:
+                    try:
+                        client.transact_write_items(
+                            TransactItems = [
+                                {
+                                    "Put": {
+                                        "TableName": database.table_name,
+                                        "Item": dict(post, postId = postid, timeBucket = database.time_bucket(post["time"], postid)),
+                                        "ConditionExpression": "attribute_not_exists(postId)"
+                                    }
+                                },
+                                {
+                                    "Delete": {
+                                        "TableName": database.table_name,
+                                        "Key": {"userId": post["userId"], "postId": post["postId"]},
+                                        "ConditionExpression": "attribute_exists(postId)"
+                                    }
+                                }
+                            ]
+                        )
+                    except client.exceptions.TransactionCanceledException:
+                        # Deleted while the migration was running
+                        skipped += 1
+                        continue
+
+                    # Only reaches a shared read cache, see above
+                    readcache.bump(post.get("author"))
+                    mapping.write(json.dumps({"old": post["postId"], "new": postid}) + "\n")
+
+                migrated += 1
+
+            print(f"{'Would migrate' if dry_run else 'Migrated'} {migrated} posts, {skipped} skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""
+Full-table reads for the tools - the function itself never scans the table. The tools
+put lambda/main on the path and set TableName before the first scan, database reads
+it on import.
+"""
+
+
+# Number of segments and threads
+scan_workers = int(os.environ.get("ScanWorkers", "4"))
+
+
+def scan_all_posts(workers = None, batch_size = 100):
+
+    """
+    Read every post with a parallel segmented scan, one segment per worker thread.
+    Yields lists of at most batch_size posts as pages arrive, in no particular order.
+    At most two pages per worker are buffered, so memory stays flat however large the table is.
+    """
+
+    import database
+
+    workers = workers or scan_workers
+    pages = queue.Queue(maxsize = workers * 2)
+    stop = threading.Event()
+    segment_done = object()
+
+    def put(item):
+        # Give up once the consumer stopped reading, otherwise a full queue would block forever
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                continue
+
+    # The low-level client is thread-safe, the Table resource is not
+    scan_client = database.get_table().meta.client
+
+    def scan_segment(segment):
+        args = {"TableName": database.table_name, "Segment": segment, "TotalSegments": workers}
+
+        try:
+            while not stop.is_set():
+                page = scan_client.scan(**args)
+                put([item for item in page["Items"] if item.get("userId") != database.TIMELINE_MARKER["userId"]])
+
+                if "LastEvaluatedKey" not in page:
+                    break
+
+                args["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+        except Exception as e:
+            put(e)
+        finally:
+            put(segment_done)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for segment in range(workers):
+            executor.submit(scan_segment, segment)
+
+        try:
+            finished = 0
+            batch = []
+
+            while finished < workers:
+                page = pages.get()
+
+                if page is segment_done:
+                    finished += 1
+                    continue
+
+                if isinstance(page, Exception):
+                    raise page
+
+                batch.extend(page)
+
+                while len(batch) >= batch_size:
+                    yield batch[:batch_size]
+                    batch = batch[batch_size:]
+
+            if batch:
+                yield batch
+        finally:
+            stop.set()
@@ -0,0 +1,423 @@
+import os
+import sys
+import threading
+import time
+import zlib
+
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "main"))
+
+
+"""
+Local stand-ins for the DynamoDB table and the Verified Permissions client
+
+They implement just the calls the function makes, with an optional injected latency
+per call, so the handler can be driven without deploying the stack. The table keeps
+the base table and all GSIs, LocalClient serves the low-level client's calls from it.
+The Verified Permissions stand-in evaluates the bundled .cedar policies with
+lambda/main/cedar.py.
+"""
+
+
+INDEXES = {
+    None: ("userId", "postId"),
+    "author_postid_index": ("author", "postId"),
+    "postid_time_index": ("postId", "time"),
+    "timeline_index": ("timeBucket", "time")
+}
+
+COMPARISONS = {
+    "=": lambda value, operands: value == operands[0],
+    "<": lambda value, operands: value < operands[0],
+    "<=": lambda value, operands: value <= operands[0],
+    ">": lambda value, operands: value > operands[0],
+    ">=": lambda value, operands: value >= operands[0],
+    "BETWEEN": lambda value, operands: operands[0] <= value <= operands[1],
+    "begins_with": lambda value, operands: value.startswith(operands[0])
+}
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class LocalTable:
+
+    def __init__(self, latency = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self._items = {}
+        self._partitions = {index: {} for index in INDEXES}
+        self._lock = threading.Lock()
+
+        # The function uses both the Table resource and its low-level client
+        self.meta = SimpleNamespace(client = self)
+        self.exceptions = SimpleNamespace(ConditionalCheckFailedException = ConditionalCheckFailedException)
+
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+    def _capacity(self, response, requested, units):
+        # Roughly what DynamoDB charges - 0.5 per eventually consistent read, 1 per small write
+        if requested and requested != "NONE":
+            response["ConsumedCapacity"] = {"TableName": "LocalTable", "CapacityUnits": units}
+
+        return response
+
+
+    def _add(self, item):
+        item = dict(item)
+        table_key = (item["userId"], item["postId"])
+        self._remove(table_key)
+        self._items[table_key] = item
+
+        for index, (partition_key, sort_key) in INDEXES.items():
+            if partition_key in item and sort_key in item:
+                self._partitions[index].setdefault(item[partition_key], {})[table_key] = item
+
+
+    def _remove(self, table_key):
+        item = self._items.pop(table_key, None)
+        if item is None:
+            return None
+
+        for index, (partition_key, sort_key) in INDEXES.items():
+            if partition_key in item:
+                self._partitions[index].get(item[partition_key], {}).pop(table_key, None)
+
+        return item
+
+
+    def seed(self, items):
+        with self._lock:
+            for item in items:
+                self._add(item)
+
+
+    def _project(self, item, projection, names):
+        if not projection:
+            return dict(item)
+
+        attributes = [(names or {}).get(name.strip(), name.strip()) for name in projection.split(",")]
+
+        return {name: item[name] for name in attributes if name in item}
+
+
+    def _key_conditions(self, condition):
+        expression = condition.get_expression()
+
+        if expression["operator"] == "AND":
+            return self._key_conditions(expression["values"][0]) + self._key_conditions(expression["values"][1])
+
+        return [(expression["values"][0].name, expression["operator"], expression["values"][1:])]
+
+
+    def _page(self, rows, sort_key, ascending, limit, start_key, projection, names):
+        def position(item):
+            return (item.get(sort_key, ""), item["userId"], item["postId"])
+
+        rows = sorted(rows, key = position, reverse = not ascending)
+
+        if start_key:
+            start = (start_key.get(sort_key, ""), start_key["userId"], start_key["postId"])
+            rows = [item for item in rows if (position(item) > start if ascending else position(item) < start)]
+
+        page = rows[:limit] if limit else rows
+        response = {
+            "Items": [self._project(item, projection, names) for item in page],
+            "Count": len(page),
+            "ScannedCount": len(page)
+        }
+
+        if limit and len(rows) > limit:
+            last = page[-1]
+            response["LastEvaluatedKey"] = {
+                name: last[name] for name in {sort_key, "userId", "postId"} | set(INDEXES[None]) if name in last
+            }
+
+        return response
+
+
+    def query(self, IndexName = None, KeyConditionExpression = None, ScanIndexForward = True, Limit = None,
+              ExclusiveStartKey = None, ProjectionExpression = None, ExpressionAttributeNames = None,
+              ReturnConsumedCapacity = None, **kwargs):
+        self._call()
+
+        return self._query(IndexName, self._key_conditions(KeyConditionExpression), ScanIndexForward, Limit,
+                           ExclusiveStartKey, ProjectionExpression, ExpressionAttributeNames, ReturnConsumedCapacity)
+
+
+    def _query(self, IndexName, conditions, ScanIndexForward, Limit, ExclusiveStartKey, ProjectionExpression,
+               ExpressionAttributeNames, ReturnConsumedCapacity):
+        partition_key, sort_key = INDEXES[IndexName]
+
+        with self._lock:
+            partition_value = next(operands[0] for name, operator, operands in conditions if name == partition_key)
+            rows = list(self._partitions[IndexName].get(partition_value, {}).values())
+
+        for name, operator, operands in conditions:
+            if name != partition_key:
+                rows = [item for item in rows if name in item and COMPARISONS[operator](item[name], operands)]
+
+        response = self._page(rows, sort_key, ScanIndexForward, Limit, ExclusiveStartKey, ProjectionExpression, ExpressionAttributeNames)
+
+        if IndexName:
+            last = response.get("LastEvaluatedKey")
+            if last is not None:
+                last[partition_key] = partition_value
+
+        return self._capacity(response, ReturnConsumedCapacity, max(0.5, 0.5 * response["Count"]))
+
+
+    def scan(self, Segment = 0, TotalSegments = 1, Limit = None, ExclusiveStartKey = None,
+             ProjectionExpression = None, ExpressionAttributeNames = None, **kwargs):
+        self._call()
+
+        with self._lock:
+            rows = [
+                item for table_key, item in self._items.items()
+                if zlib.crc32("|".join(table_key).encode()) % TotalSegments == Segment
+            ]
+
+        return self._page(rows, "postId", True, Limit, ExclusiveStartKey, ProjectionExpression, ExpressionAttributeNames)
+
+
+    def put_item(self, Item, ReturnConsumedCapacity = None, **kwargs):
+        self._call()
+
+        with self._lock:
+            self._add(Item)
+
+        return self._capacity({}, ReturnConsumedCapacity, 1.0)
+
+
+    def get_item(self, Key, ProjectionExpression = None, ExpressionAttributeNames = None, ReturnConsumedCapacity = None, **kwargs):
+        self._call()
+
+        with self._lock:
+            item = self._items.get((Key["userId"], Key["postId"]))
+
+        response = {"Item": self._project(item, ProjectionExpression, ExpressionAttributeNames)} if item else {}
+
+        return self._capacity(response, ReturnConsumedCapacity, 0.5)
+
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression = None, ExpressionAttributeValues = None,
+                    ReturnConsumedCapacity = None, **kwargs):
+
+        """
+        Just "SET name = :value, ..." with a condition of "attribute_not_exists(name)",
+        "attribute_exists(name)" or "name op :value" terms joined by OR
+        """
+
+        self._call()
+        values = ExpressionAttributeValues or {}
+
+        with self._lock:
+            item = dict(self._items.get((Key["userId"], Key["postId"])) or Key)
+
+            if ConditionExpression and not any(self._term(item, term.split(), values) for term in ConditionExpression.split(" OR ")):
+                raise ConditionalCheckFailedException("The conditional request failed")
+
+            for assignment in UpdateExpression[len("SET "):].split(","):
+                name, value = [part.strip() for part in assignment.split("=")]
+                item[name] = values[value]
+
+            self._add(item)
+
+        return self._capacity({}, ReturnConsumedCapacity, 1.0)
+
+
+    def _term(self, item, term, values):
+        if len(term) == 1:
+            function, name = term[0].rstrip(")").split("(")
+            return (name in item) == (function == "attribute_exists")
+
+        name, operator, value = term
+        return name in item and COMPARISONS[operator](item[name], [values[value]])
+
+
+    def delete_item(self, Key, ConditionExpression = None, ReturnValues = None, ReturnConsumedCapacity = None, **kwargs):
+        self._call()
+
+        with self._lock:
+            removed = self._remove((Key["userId"], Key["postId"]))
+
+        if removed is None and ConditionExpression:
+            raise ConditionalCheckFailedException("The conditional request failed")
+
+        response = {"Attributes": dict(removed)} if removed and ReturnValues == "ALL_OLD" else {}
+
+        return self._capacity(response, ReturnConsumedCapacity, 1.0)
+
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity = None, **kwargs):
+        self._call()
+
+        with self._lock:
+            for requests in RequestItems.values():
+                for request in requests:
+                    if "PutRequest" in request:
+                        self._add(request["PutRequest"]["Item"])
+                    else:
+                        key = request["DeleteRequest"]["Key"]
+                        self._remove((key["userId"], key["postId"]))
+
+        response = self._capacity({"UnprocessedItems": {}}, ReturnConsumedCapacity, float(sum(len(requests) for requests in RequestItems.values())))
+        if "ConsumedCapacity" in response:
+            response["ConsumedCapacity"] = [response["ConsumedCapacity"]]
+
+        return response
+
+
+class LocalClient:
+
+    """
+    The low-level DynamoDB client on top of a LocalTable - takes and returns items in the
+    wire format and string key conditions like "#bucket = :bucket AND #time < :before"
+    """
+
+    def __init__(self, table):
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+        self.table = table
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+
+    def _item(self, item):
+        # Posts only hold strings, skip the serializer for them so the stand-in does not dominate the timings
+        return {
+            name: {"S": value} if isinstance(value, str) else self._serializer.serialize(value)
+            for name, value in item.items()
+        } if item else item
+
+
+    def _plain(self, item):
+        return {name: self._deserializer.deserialize(value) for name, value in item.items()} if item else item
+
+
+    def get_item(self, Key, ReturnConsumedCapacity = None, **kwargs):
+        response = self.table.get_item(self._plain(Key), ReturnConsumedCapacity = ReturnConsumedCapacity, **kwargs)
+
+        if "Item" in response:
+            response["Item"] = self._item(response["Item"])
+
+        return response
+
+
+    def query(self, IndexName = None, KeyConditionExpression = None, ExpressionAttributeNames = None,
+              ExpressionAttributeValues = None, ScanIndexForward = True, Limit = None, ExclusiveStartKey = None,
+              ProjectionExpression = None, ReturnConsumedCapacity = None, **kwargs):
+        self.table._call()
+        names = ExpressionAttributeNames or {}
+        values = self._plain(ExpressionAttributeValues or {})
+        conditions = []
+
+        # "name op :value" or "name BETWEEN :low AND :high", joined by AND
+        tokens = KeyConditionExpression.split()
+        while tokens:
+            name, operator, value = tokens[:3]
+            operands = [values[value]]
+            tokens = tokens[3:]
+
+            if operator == "BETWEEN":
+                operands.append(values[tokens[1]])
+                tokens = tokens[2:]
+
+            conditions.append((names.get(name, name), operator, operands))
+            tokens = tokens[1:]
+
+        response = self.table._query(IndexName, conditions, ScanIndexForward, Limit, self._plain(ExclusiveStartKey),
+                                     ProjectionExpression, names, ReturnConsumedCapacity)
+
+        response["Items"] = [self._item(item) for item in response["Items"]]
+        if "LastEvaluatedKey" in response:
+            response["LastEvaluatedKey"] = self._item(response["LastEvaluatedKey"])
+
+        return response
+
+
+class LocalVerifiedPermissions:
+
+    def __init__(self, policy_set, latency = 0.0):
+        self.policy_set = policy_set
+        self.latency = latency
+        self.calls = 0
+
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+    def _value(self, value):
+        import cedar
+
+        if "entityIdentifier" in value:
+            return cedar.Entity(value["entityIdentifier"]["entityType"], value["entityIdentifier"]["entityId"])
+
+        if "record" in value:
+            return {name: self._value(item) for name, item in value["record"].items()}
+
+        if "set" in value:
+            return [self._value(item) for item in value["set"]]
+
+        return next(iter(value.values()))
+
+
+    def _decide(self, claims, action, resource, entity_list):
+        import cedar
+        import permissions
+
+        principal, attributes = permissions.principal_entity(claims)
+        entities = {principal: {"attrs": attributes}}
+
+        for entity in entity_list:
+            identifier = cedar.Entity(entity["identifier"]["entityType"], entity["identifier"]["entityId"])
+            entities[identifier] = {
+                "attrs": {name: self._value(value) for name, value in entity.get("attributes", {}).items()}
+            }
+
+        result = self.policy_set.is_authorized(
+            principal,
+            cedar.Entity(action["actionType"], action["actionId"]),
+            cedar.Entity(resource["entityType"], resource["entityId"]),
+            entities
+        )
+
+        return {
+            "decision": result.decision,
+            "determiningPolicies": [{"policyId": policy_id} for policy_id in result.determining_policies],
+            "errors": [{"errorDescription": error} for error in result.errors]
+        }
+
+
+    def is_authorized_with_token(self, identityToken, action, resource, entities = None, **kwargs):
+        import tokens
+
+        self._call()
+        claims = tokens.unverified_claims(identityToken)
+
+        return self._decide(claims, action, resource, (entities or {}).get("entityList", []))
+
+
+    def batch_is_authorized_with_token(self, identityToken, requests, entities = None, **kwargs):
+        import tokens
+
+        self._call()
+        claims = tokens.unverified_claims(identityToken)
+        entity_list = (entities or {}).get("entityList", [])
+
+        return {
+            "results": [
+                dict(self._decide(claims, request["action"], request["resource"], entity_list), request = request)
+                for request in requests
+            ]
+        }